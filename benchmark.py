@@ -0,0 +1,182 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import replace
+from itertools import product
+from typing import Any
+import numpy as np
+import PIL
+from main import LAYERS, galaxy_stages, load_settings, worker_modules
+from src.export_png import export_as_png
+from src.utils.layer_store import LayerFile, init_worker
+from src.utils.result_obj import Result
+from src.utils.scheduler import Stage, preload
+from src.utils.settings import Settings
+from src.utils.telemetry import peak_rss_mb
+
+# Benchmarked stages and the parameters their work depends on, "png" is the compositor
+BENCH_STAGES = {
+    "background": ("size",),
+    "arm_3": ("size", "arms"),
+    "h2_nebula": ("size", "arms"),
+    "dust_nebula": ("size", "arms"),
+    "stars": ("size", "arms", "stars"),
+    "hyperlanes": ("size", "arms", "stars"),
+    "zip": ("size", "arms", "stars"),
+    "png": ("size", "arms", "stars"),
+}
+BENCH_SEED = 1234
+
+def call_stage(stage: Stage, results: dict[str, Result]) -> Result:
+    # What run_stages does for one stage, in this process
+    parts = [part.fn(*part.args, **part.kwargs) for part in stage.parts]
+    return stage.fn(*stage.args, *(results[dep] for dep in stage.deps), *parts, **stage.kwargs)
+
+def layer_bytes(result: Result) -> int:
+    if isinstance(result.image, LayerFile):
+        return result.image.nbytes
+    return result.image.width * result.image.height * len(result.image.mode)
+
+def run_case(settings: Settings, stage_name: str, size: int, arms: int, num_stars: int, galaxy_type: str, seed: int) -> dict[str, Any]:
+    # Runs in a fresh process, so the peak RSS belongs to this case alone
+    work_dir = tempfile.mkdtemp(prefix="galaxy_bench_", dir=settings.performance.work_dir or None)
+    output_dir = os.path.join(work_dir, "output")
+    os.makedirs(os.path.join(work_dir, "layers"))
+    os.makedirs(output_dir)
+    init_worker(os.path.join(work_dir, "layers"))
+    # Like a pool worker, so no import lands in the timed part
+    preload(worker_modules(settings))
+    try:
+        stages = {stage.name: stage for stage in galaxy_stages(settings, settings.galaxy_types[galaxy_type], size, arms, num_stars, seed, output_dir)}
+        deps = LAYERS if stage_name == "png" else stages[stage_name].deps
+        # The per-arm stages are part of generating the hyperlanes
+        timed = [name for name in deps if name.startswith("hyperlanes_arm_")]
+        needed, pending = set(), list(deps)
+        while pending:
+            name = pending.pop()
+            if name not in needed:
+                needed.add(name)
+                pending.extend(stages[name].deps)
+
+        # Stages are listed after their dependencies
+        results: dict[str, Result] = {}
+        for name, stage in stages.items():
+            if name in needed and name not in timed:
+                results[name] = call_stage(stage, results)
+        setup_rss = peak_rss_mb()
+
+        start_time = time.perf_counter()
+        for name in timed:
+            results[name] = call_stage(stages[name], results)
+        if stage_name == "png":
+            result = export_as_png(settings, size, *(results[name] for name in LAYERS), output_dir=output_dir)
+        else:
+            result = call_stage(stages[stage_name], results)
+        wall = time.perf_counter() - start_time
+
+        written = sum(os.path.getsize(os.path.join(directory, file)) for directory, _, files in os.walk(output_dir) for file in files)
+        return {
+            "wall_s": round(wall, 4),
+            # Particles drawn, star spawn attempts or hyperlane edges
+            "particles": result.particles,
+            "particles_per_s": round(result.particles / wall) if result.particles and wall > 0 else None,
+            "layer_bytes": sum(layer_bytes(results[name]) for name in deps if name in LAYERS) if stage_name in ("zip", "png") else layer_bytes(result),
+            "output_bytes": written,
+            "setup_rss_mb": setup_rss,
+            "peak_rss_mb": peak_rss_mb(),
+        }
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+def bench_cases(stages: list[str], sizes: list[int], arms: list[int], stars: list[int]) -> list[tuple[str, int|None, int|None, int|None]]:
+    # Parameters a stage doesn't depend on are left out instead of being swept
+    cases = []
+    for stage in stages:
+        if stage not in BENCH_STAGES:
+            raise ValueError(f"Unknown benchmark stage '{stage}', choose from {list(BENCH_STAGES)}")
+        inputs = BENCH_STAGES[stage]
+        for size, arm_count, num_stars in product(sizes, arms, stars):
+            case = (stage, size, arm_count if "arms" in inputs else None, num_stars if "stars" in inputs else None)
+            if case not in cases:
+                cases.append(case)
+    return cases
+
+def run_benchmark(settings: Settings, cases: list[tuple[str, int|None, int|None, int|None]], galaxy_type: str, seed: int, repeat: int) -> list[dict[str, Any]]:
+    # Nothing may come from the cache or open a window, every export is enabled
+    settings.export = replace(settings.export, png=True, zip=True, show=False, graph=False, star_catalog="", tiles="")
+    settings.performance = replace(settings.performance, cache_dir="")
+    records = []
+    # Every case gets a fresh interpreter, so imports and the peak RSS of earlier cases don't leak into it
+    context = multiprocessing.get_context("spawn")
+    for stage, size, arms, num_stars in cases:
+        runs = []
+        for _ in range(repeat):
+            with ProcessPoolExecutor(1, mp_context=context) as executor:
+                runs.append(executor.submit(run_case, settings, stage, size, arms or 4, num_stars or 40000, galaxy_type, seed).result())
+        # The fastest run is the one least disturbed by the rest of the machine
+        record: dict[str, Any] = {"stage": stage, "size": size, "arms": arms, "stars": num_stars, **min(runs, key=lambda run: run["wall_s"])}
+        rss = [run["peak_rss_mb"] for run in runs if run["peak_rss_mb"] is not None]
+        record["peak_rss_mb"] = max(rss) if rss else None
+        records.append(record)
+        print(f"{stage:<12} size={size:<6} arms={arms if arms is not None else '-':<3} stars={num_stars if num_stars is not None else '-':<8} "
+              f"{record['wall_s']:>8.3f}s  {record['particles_per_s'] or '-':>10} particles/s  {record['peak_rss_mb'] or '-':>8} MB")
+    return records
+
+def compare(records: list[dict[str, Any]], baseline: list[dict[str, Any]], tolerance: float) -> list[dict[str, Any]]:
+    # Cases are matched by stage and parameters, new or dropped ones are ignored
+    key = lambda record: (record["stage"], record["size"], record["arms"], record["stars"])
+    previous = {key(record): record for record in baseline}
+    regressions = []
+    for record in records:
+        old = previous.get(key(record))
+        if old is None or not old["wall_s"]:
+            continue
+        ratio = record["wall_s"] / old["wall_s"]
+        record["baseline_wall_s"] = old["wall_s"]
+        record["ratio"] = round(ratio, 3)
+        marker = "SLOWER" if ratio > 1 + tolerance else "faster" if ratio < 1 - tolerance else ""
+        print(f"{record['stage']:<12} size={record['size']:<6} {old['wall_s']:>8.3f}s -> {record['wall_s']:>8.3f}s  x{ratio:.2f} {marker}")
+        if ratio > 1 + tolerance:
+            regressions.append(record)
+    return regressions
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark every generator and exporter in isolation")
+    parser.add_argument("--settings", default="settings.hjson", help="settings file to benchmark")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 2000], help="image sizes to sweep")
+    parser.add_argument("--stars", type=int, nargs="+", default=[40000], help="star spawn counts to sweep")
+    parser.add_argument("--arms", type=int, nargs="+", default=[4], help="arm counts to sweep")
+    parser.add_argument("--type", default="Sb", help="galaxy type")
+    parser.add_argument("--stages", nargs="+", default=list(BENCH_STAGES), help="stages to benchmark")
+    parser.add_argument("--seed", type=int, default=BENCH_SEED, help="seed of every case")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per case, the fastest counts")
+    parser.add_argument("--output", metavar="FILE", help="write the results as JSON")
+    parser.add_argument("--baseline", metavar="FILE", help="compare against the JSON of an earlier run, exits with 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="slowdown that counts as a regression")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    args = parse_args()
+    settings = load_settings(args.settings)
+    cases = bench_cases(args.stages, args.sizes, args.arms, args.stars)
+    records = run_benchmark(settings, cases, args.type, args.seed, args.repeat)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            regressions = compare(records, json.load(f)["results"], args.tolerance)
+        print(f"{len(regressions)} regression(s) beyond {round(args.tolerance * 100)}%")
+    if args.output:
+        environment = {"python": platform.python_version(), "numpy": np.__version__, "pillow": PIL.__version__,
+                       "platform": platform.platform(), "cpus": os.cpu_count()}
+        with open(args.output, "w") as f:
+            json.dump({"environment": environment, "settings": args.settings, "type": args.type, "seed": args.seed, "results": records}, f, indent=2)
+    sys.exit(1 if regressions else 0)
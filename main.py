@@ -1,101 +1,350 @@
+import argparse
+import copy
+import glob
+import hashlib
+import json
+import pickle
+import sys
 import time
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import BrokenExecutor, Executor, ProcessPoolExecutor
+from dataclasses import replace
+from typing import Any, Callable, Iterable
 import multiprocessing
 from PIL import Image
-from src.export_zip import export_as_zip
-from src.export_png import export_as_png
-from src.generate_background import generate_background
-from src.generate_dust import generate_dust_lanes
-from src.generate_hyperlanes import generate_hyperlanes
-from src.generate_nebula import generate_nebula
-from src.generate_spirals import generate_spiral_arms
-from src.generate_stars import generate_stars
-from src.utils.settings import Settings
+from src.utils.settings import Settings, GalaxyType
 from src.utils.result_obj import Result
-import hjson
+from src.utils.layer_store import LayerFile, init_worker
+from src.utils.scheduler import Stage, preload, run_stages
+from src.utils.tiles import band_boxes, join_bands
+from src.utils.seeding import child_seed, random_seed, stage_seed
+from src.utils.cache import LayerCache, code_version
+from src.utils.blur import check_blur_engine
+from src.utils.image_formats import check_image_format
+from src.utils.particles import check_particle_backend
+from src.utils import telemetry
 import os
+import shutil
+import tempfile
+
+def settings_cache_path(config_path: str, raw: bytes) -> str:
+    # Next to the settings file like Python's own bytecode cache, keyed on its
+    # contents and on the code, so editing either parses the file again
+    digest = hashlib.sha256(raw + code_version().encode()).hexdigest()[:16]
+    directory, file = os.path.split(os.path.abspath(config_path))
+    return os.path.join(directory, "__pycache__", f"{file}.{digest}.pickle")
 
 def load_settings(config_path:str='settings.hjson') -> Settings:
     if os.path.exists(config_path):
         try:
-            with open(config_path, 'r') as f:
-                raw_data = hjson.load(f)
-            settings = Settings(**raw_data)
+            with open(config_path, 'rb') as f:
+                raw = f.read()
+            cache_path = settings_cache_path(config_path, raw)
+            try:
+                with open(cache_path, 'rb') as f:
+                    return pickle.load(f)
+            except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+                pass
+
+            import hjson
+            settings = Settings(**hjson.loads(raw.decode("utf-8")))
+            try:
+                # Older entries of this file are stale now
+                for stale in glob.glob(glob.escape(cache_path.rsplit(".", 2)[0]) + ".*.pickle"):
+                    os.remove(stale)
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                with open(f"{cache_path}.{os.getpid()}", 'wb') as f:
+                    pickle.dump(settings, f, pickle.HIGHEST_PROTOCOL)
+                os.replace(f"{cache_path}.{os.getpid()}", cache_path)
+            except OSError:
+                pass # A read-only install just parses every time
             return settings
-        except (hjson.HjsonDecodeError, IOError):
+        except (ValueError, IOError):
             print(f"Warning: Could not parse {config_path}. Using defaults.")
         return Settings(**{})
     else:
         return Settings(**{})
 
-def generate_galaxy(settings: Settings, size:int, galaxy_type:str, arms:int, num_stars:int) -> None:
-    start_time = time.time()
+def worker_modules(settings: Settings) -> tuple[str, ...]:
+    # What the workers import as they start, modules of disabled steps (SciPy
+    # without hyperlanes) are never imported
+    steps, export = settings.steps, settings.export
+    modules = ["src.generate_background"]
+    modules += ["src.generate_spirals"] if steps.spirals else []
+    modules += ["src.generate_nebula"] if steps.nebula else []
+    modules += ["src.generate_dust"] if steps.dust else []
+    modules += ["src.generate_stars"] if steps.stars else []
+    modules += ["src.generate_hyperlanes", "scipy.spatial"] if steps.stars and steps.hyperlanes else []
+    modules += ["src.export_zip"] if export.zip else []
+    modules += ["src.export_graph"] if export.graph else []
+    modules += ["src.export_catalog"] if export.star_catalog else []
+    modules += ["src.export_tiles"] if export.tiles else []
+    return tuple(modules)
+
+def worker_pool(settings: Settings) -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max_workers=settings.performance.workers or None, initializer=preload, initargs=(worker_modules(settings),))
+
+# Previews smaller than this lose the shape of the arms
+PREVIEW_MIN_SIZE = 256
+
+# Stages in the timing summary
+SUMMARY_LABELS = {
+    "png": "Composition (Image)", "zip": "Composition (ZIP)", "graph": "Hyperlane Graph", "catalog": "Star Catalog", "tiles": "Tile Pyramid", "background": "Background",
+    **{f"arm_{i}": f"Spiral Arm Pass {i}" for i in range(1, 6)},
+    "h2_nebula": "Hydrogen Nebula", "dust_nebula": "Dust Nebula", "hyperlanes": "Hyperlanes", "stars": "Stars",
+}
+
+# Order in which the ZIP exporter expects the layers
+LAYERS = ("background", "arm_1", "arm_2", "arm_3", "arm_4", "arm_5", "h2_nebula", "hyperlanes", "stars", "dust_nebula")
+
+def particle_stage(settings: Settings, size: int, name: str, fn: Callable, args: tuple, mode: str, cache_inputs: tuple) -> Stage:
+    bands = settings.performance.particle_bands
+    if not bands:
+        return Stage(name, fn, args, cache_inputs=cache_inputs)
+
+    # Bands render into one shared layer with halos, so the result is the same as a single pass
+    layer = LayerFile.create(size, mode)
+    parts = tuple(Stage(f"{name}_band_{index}", fn, args, kwargs={"band": (layer, box)}) for index, box in enumerate(band_boxes(size, -(-size // bands))))
+    return Stage(name, join_bands, (bool(settings.performance.tile_size),), parts=parts, cache_inputs=cache_inputs)
+
+def galaxy_stages(settings: Settings, galaxy_config: GalaxyType, size: int, arms: int, num_stars: int, seed: int, output_dir: str=".") -> list[Stage]:
+    # Imported here instead of at the top, so spawned workers, which import
+    # this module again, only import the generators of the stages they run
+    from src.export_catalog import export_star_catalog
+    from src.export_graph import export_hyperlane_graph
+    from src.export_zip import export_as_zip
+    from src.generate_background import generate_background
+    from src.generate_dust import generate_dust_lanes
+    from src.generate_hyperlanes import generate_arm_hyperlanes, generate_hyperlanes
+    from src.generate_nebula import generate_nebula
+    from src.generate_spirals import generate_spiral_arms
+    from src.generate_stars import generate_stars
+
     center = size // 2
     scale = size / 20
+    steps, generation, fragmentation = settings.steps, settings.generation, settings.generation.fragmentation
+
+    # Cache keys only cover the settings a stage actually reads, so tweaking one layer keeps the others
+    common = (galaxy_config, size, arms, seed, settings.performance.particle_backend, settings.performance.blur_engine)
+    spirals = (common, steps.spirals, generation.spirals, fragmentation.spirals)
+    hyperlanes = (common, steps.hyperlanes, generation.hyperlanes, fragmentation.hyperlanes, fragmentation.small_hyperlanes)
+    lane_arms = tuple(f"hyperlanes_arm_{arm_index}" for arm_index in range(arms))
+    # Tiled renders place stars in batches whatever the setting, the key follows the path that runs
+    vectorized_stars = settings.performance.vectorized_stars or bool(settings.performance.tile_size)
+
+    # Independent stages are started in this order, so the slow ones come first
+    return [
+        Stage("stars", generate_stars, (settings, galaxy_config, center, scale, size, arms, num_stars, stage_seed(seed, "stars")),
+              cache_inputs=(common, steps.stars, fragmentation.stars, num_stars, vectorized_stars)),
+        *(Stage(name, generate_arm_hyperlanes, (settings, galaxy_config, center, scale, size, arms, arm_index, child_seed(stage_seed(seed, "hyperlanes"), arm_index)), deps=("stars",), cache_inputs=hyperlanes)
+          for arm_index, name in enumerate(lane_arms)),
+        Stage("hyperlanes", generate_hyperlanes, (settings, size), deps=lane_arms, cache_inputs=(size, steps.stars, steps.hyperlanes)),
+        particle_stage(settings, size, "arm_1", generate_spiral_arms, (settings, galaxy_config, center, scale*0.5, size, arms, [(0, 0, 0, 0), (87, 161, 191, 50), (30, 65, 79)], 0.1, stage_seed(seed, "arm_1")), "RGBA", spirals),
+        particle_stage(settings, size, "arm_2", generate_spiral_arms, (settings, galaxy_config, center, scale, size, arms, [(0, 0, 0, 0), (87, 161, 191, 50), (30, 65, 79)], 0.1, stage_seed(seed, "arm_2")), "RGBA", spirals),
+        particle_stage(settings, size, "arm_3", generate_spiral_arms, (settings, galaxy_config, center, scale*1, size, arms, [(255, 240, 200), (100, 50, 200), (20, 30, 60)], 0.15, stage_seed(seed, "arm_3")), "RGBA", spirals),
+        particle_stage(settings, size, "arm_4", generate_spiral_arms, (settings, galaxy_config, center, scale*2, size, arms, [(255, 240, 200), (50, 60, 250), (10, 10, 90)], 0.15, stage_seed(seed, "arm_4")), "RGBA", spirals),
+        particle_stage(settings, size, "arm_5", generate_spiral_arms, (settings, galaxy_config, center, scale*2, size, arms, [(0, 0, 0), (71, 42, 6), (0, 0, 0)], 0.05, stage_seed(seed, "arm_5")), "RGBA", spirals),
+        particle_stage(settings, size, "background", generate_background, (settings, size, center, stage_seed(seed, "background")), "RGBA",
+                       (size, seed, settings.performance.particle_backend, settings.performance.blur_engine)),
+        particle_stage(settings, size, "h2_nebula", generate_nebula, (settings, galaxy_config, center, scale, size, arms, stage_seed(seed, "h2_nebula")), "RGBA",
+                       (common, steps.nebula, generation.nebula, fragmentation.nebula)),
+        particle_stage(settings, size, "dust_nebula", generate_dust_lanes, (settings, galaxy_config, center, scale, size, arms, stage_seed(seed, "dust_nebula")), "L",
+                       (common, steps.dust, generation.dust)),
+        Stage("zip", export_as_zip, (settings, size), deps=LAYERS, kwargs={"output_dir": output_dir}),
+        Stage("graph", export_hyperlane_graph, (settings,), deps=("hyperlanes",), kwargs={"output_dir": output_dir}),
+        Stage("catalog", export_star_catalog, (settings,), deps=("stars",), kwargs={"output_dir": output_dir}),
+    ]
+
+def generate_galaxy(settings: Settings, size:int, galaxy_type:str, arms:int, num_stars:int, seed: int, executor: Executor|None=None, output_dir: str=".", name: str="galaxy") -> dict[str, Result]:
     galaxy_config = settings.galaxy_types.get(galaxy_type, None)
     if galaxy_config == None:
-        print(f"Invalid Galaxy Type: '{galaxy_type}'!")
-        time.sleep(10)
-        exit()
+        raise ValueError(f"Invalid Galaxy Type: '{galaxy_type}'!")
     if arms <= 2:
-        print("The Galaxy must have atleast 3 arms!")
-        time.sleep(10)
-        exit()
+        raise ValueError("The Galaxy must have atleast 3 arms!")
+    from src.export_catalog import check_catalog
+    from src.export_png import Compositor
+    from src.export_tiles import check_tiles, export_pyramid
+    check_image_format(settings.export)
+    check_particle_backend(settings.performance.particle_backend)
+    check_blur_engine(settings.performance.blur_engine)
+    check_tiles(settings, size)
+    check_catalog(settings)
 
-    print("Working...")
-    with ProcessPoolExecutor() as executor:
-        bk_future = executor.submit(generate_background, settings, size, center)
-        stars_future = executor.submit(generate_stars, settings, galaxy_config, center, scale, size, arms, num_stars)
-        arm_1_future = executor.submit(generate_spiral_arms, settings, galaxy_config, center, scale*0.5, size, arms, [(0, 0, 0, 0), (87, 161, 191, 50), (30, 65, 79)], 0.1)
-        arm_2_future = executor.submit(generate_spiral_arms, settings, galaxy_config, center, scale, size, arms, [(0, 0, 0, 0), (87, 161, 191, 50), (30, 65, 79)], 0.1)
-        arm_3_future = executor.submit(generate_spiral_arms, settings, galaxy_config, center, scale*1, size, arms, [(255, 240, 200), (100, 50, 200), (20, 30, 60)], 0.15)
-        arm_4_future = executor.submit(generate_spiral_arms, settings, galaxy_config, center, scale*2, size, arms, [(255, 240, 200), (50, 60, 250), (10, 10, 90)], 0.15)
-        arm_5_future = executor.submit(generate_spiral_arms, settings, galaxy_config, center, scale*2, size, arms, [(0, 0, 0), (71, 42, 6), (0, 0, 0)], 0.05)
-        dust_nebula_future = executor.submit(generate_dust_lanes, settings, galaxy_config, center, scale, size, arms)
-        h2_nebula_future = executor.submit(generate_nebula, settings, galaxy_config, center, scale, size, arms)
-
-        background = bk_future.result()
-        stars = stars_future.result()
-        arm_1 = arm_1_future.result()
-        arm_2 = arm_2_future.result()
-        arm_3 = arm_3_future.result()
-        arm_4 = arm_4_future.result()
-        arm_5 = arm_5_future.result()
-        dust_nebula = dust_nebula_future.result()
-        h2_nebula = h2_nebula_future.result()
-
-    hyperlane_result = generate_hyperlanes(settings, galaxy_config, center, scale, size, arms, stars.data[0])
-
-    print("Exporting...")
-    with ProcessPoolExecutor() as executor:
-        png_future = executor.submit(export_as_png, settings, size, background, arm_1, arm_2, arm_3, arm_4, arm_5, h2_nebula, hyperlane_result, stars, dust_nebula)
-        zip_future = executor.submit(export_as_zip, settings, size, background, arm_1, arm_2, arm_3, arm_4, arm_5, h2_nebula, hyperlane_result, stars, dust_nebula)
-
-        png = png_future.result()
-        zip = zip_future.result()
-
-    print(f"Saved {size}x{size} PNG as galaxy.png")
-    print(f"Total stars placed: {stars.data[0].__len__() if stars.data else "NaN"}/{num_stars}")
-    print(f"""Generation took a total of {round(time.time() - start_time, 2)}s
-- Composition (PNG): {round(png.time, 2).__str__() + "s" if png.time else "[skipped]"}
-- Composition (ZIP): {round(zip.time, 2).__str__() + "s" if zip.time else "[skipped]"}
-- Background: {round(background.time, 2).__str__() + "s" if background.time else "[skipped]"}
-- Spiral Arm Pass 1: {round(arm_1.time, 2).__str__() + "s" if arm_1.time else "[skipped]"}
-- Spiral Arm Pass 2: {round(arm_2.time, 2).__str__() + "s" if arm_2.time else "[skipped]"}
-- Spiral Arm Pass 3: {round(arm_3.time, 2).__str__() + "s" if arm_3.time else "[skipped]"}
-- Spiral Arm Pass 4: {round(arm_4.time, 2).__str__() + "s" if arm_4.time else "[skipped]"}
-- Spiral Arm Pass 5: {round(arm_5.time, 2).__str__() + "s" if arm_5.time else "[skipped]"}
-- Hydrogen Nebula: {round(h2_nebula.time, 2).__str__() + "s" if h2_nebula.time else "[skipped]"}
-- Dust Nebula: {round(dust_nebula.time, 2).__str__() + "s" if dust_nebula.time else "[skipped]"}
-- Hyperlanes: {round(hyperlane_result.time, 2).__str__() + "s" if hyperlane_result.time else "[skipped]"}
-- Stars: {round(stars.time, 2).__str__() + "s" if stars.time else "[skipped]"}""")
+    os.makedirs(output_dir, exist_ok=True)
+    # Layer files live here until the exporters are done with them
+    layers_dir = tempfile.mkdtemp(prefix="galaxy_layers_", dir=settings.performance.work_dir or None)
+    init_worker(layers_dir)
+    own_executor = executor is None
+    if executor is None:
+        executor = worker_pool(settings)
+    results: dict[str, Result] = {}
+    compositor = None
+    try:
+        trace_dir = None
+        if settings.performance.telemetry:
+            trace_dir = os.path.join(layers_dir, "telemetry")
+            os.makedirs(trace_dir)
+            profile_dir = os.path.join(output_dir, "profiles") if settings.performance.profile else None
+            if profile_dir:
+                os.makedirs(profile_dir, exist_ok=True)
+            telemetry.configure(trace_dir, profile_dir)
 
-    print("This window will close in 10 seconds.")
-    time.sleep(10)
+        cache = None
+        if settings.performance.cache_dir:
+            cache = LayerCache(settings.performance.cache_dir, settings.performance.cache_limit_mb, bool(settings.performance.tile_size))
+        compositor = Compositor(settings, size)
+        stages = galaxy_stages(settings, galaxy_config, size, arms, num_stars, seed, output_dir)
+        results = run_stages(executor, stages, layers_dir, on_result=compositor.add, cache=cache)
+        with telemetry.span("png"):
+            results["png"] = compositor.save(output_dir, name)
+        # The pyramid starts from the finished composite
+        with telemetry.span("tiles"):
+            results["tiles"] = export_pyramid(settings, size, compositor.canvas, executor, output_dir)
+
+        if trace_dir:
+            records = telemetry.read_records(trace_dir)
+            trace_path = os.path.join(output_dir, f"{name}_trace.json")
+            telemetry.write_chrome_trace(records, trace_path)
+            results["telemetry"] = Result(None, Image.new("RGBA", (1, 1), (0, 0, 0, 0)), trace_path, records)
+    finally:
+        telemetry.configure(None)
+        if own_executor:
+            executor.shutdown()
+        # Every map of a layer file has to go before the files can, on Windows
+        if compositor is not None:
+            compositor.close()
+        for result in results.values():
+            result.close()
+        shutil.rmtree(layers_dir, ignore_errors=True)
+        if os.path.exists(layers_dir):
+            print(f"Warning: Could not remove the layer files in {layers_dir}")
+    return results
+
+def generate_preview(settings: Settings, size:int, galaxy_type:str, arms:int, num_stars:int, seed: int, factor: int, executor: Executor|None=None, output_dir: str=".") -> tuple[int, dict[str, Result]]:
+    # Generators derive their particle counts and radii from the size, only the
+    # star spawns are scaled here. Layer and graph exports wait for the full render
+    preview_size = min(size, max(size // factor, PREVIEW_MIN_SIZE))
+    preview = copy.copy(settings)
+    preview.export = replace(settings.export, format="png_fast", zip=False, graph=False, star_catalog="", tiles="")
+    preview_stars = max(1, num_stars * preview_size**2 // size**2)
+    return preview_size, generate_galaxy(preview, preview_size, galaxy_type, arms, preview_stars, seed, executor, output_dir, "galaxy_preview")
+
+def format_time(result: Result) -> str:
+    if result.cached:
+        return "[cached]"
+    return f"{round(result.time, 2)}s" if result.time else "[skipped]"
+
+def stage_usage(records: list[dict[str, Any]], name: str) -> str:
+    # Bands of a stage are recorded on their own and add up to it
+    own = [record for record in records if record["name"] == name or record["name"].startswith(f"{name}_band_")]
+    if not own:
+        return ""
+    cpu = sum(record["cpu_s"] for record in own)
+    rss = max((record["peak_rss_mb"] or 0 for record in own), default=0)
+    return f" (cpu {round(cpu, 2)}s, peak {rss} MB)"
+
+def print_summary(results: dict[str, Result], size: int, num_stars: int, seed: int, total_time: float) -> None:
+    stars = results["stars"]
+    placed = len(stars.data[0]) if stars.data else "NaN"
+    if results["png"].data:
+        print(f"Saved {size}x{size} image as {results['png'].data[0]}")
+    print(f"Total stars placed: {placed}/{num_stars}")
+    print(f"Seed: {seed}")
+    print(f"Generation took a total of {round(total_time, 2)}s")
+    records = results["telemetry"].data[1] if "telemetry" in results else []
+    for name, label in SUMMARY_LABELS.items():
+        usage = stage_usage(records, name) if results[name].time else ""
+        print(f"- {label}: {format_time(results[name])}{usage}")
+    lane_arms = [result for name, result in results.items() if name.startswith("hyperlanes_arm_")]
+    print(f"- Hyperlane Arms: {round(sum(result.time or 0 for result in lane_arms), 2)}s in {len(lane_arms)} stages")
+
+    if records:
+        counters = {}
+        for record in records:
+            for key, value in record["counters"].items():
+                counters[key] = counters.get(key, 0) + value
+        candidates = counters.get("stars_attempted", 0) - counters.get("stars_out_of_bounds", 0)
+        if candidates:
+            print(f"Star collisions rejected {round(100 * counters.get('stars_rejected', 0) / candidates, 1)}% of {candidates} in-bounds spawns")
+        print(f"Star queries: {counters.get('kdtree_queries', 0)} nearest, {counters.get('grid_radius_queries', 0)} radius")
+        print(f"IPC: {round((counters.get('ipc_in_bytes', 0) + counters.get('ipc_out_bytes', 0)) / 1e6, 2)} MB between processes")
+        print(f"Trace saved as {results['telemetry'].data[0]}")
+
+def read_jobs(lines: Iterable[str]) -> list[tuple[int, int, str, int, int]]:
+    # One job per line: seed size type arms stars, separated by whitespace or commas
+    jobs = []
+    for number, line in enumerate(lines, 1):
+        fields = line.split("#", 1)[0].replace(",", " ").split()
+        if not fields:
+            continue
+        if len(fields) != 5:
+            raise ValueError(f"Line {number}: expected 'seed size type arms stars', got '{line.strip()}'")
+        seed, size, galaxy_type, arms, stars = fields
+        jobs.append((int(seed), int(size), galaxy_type, int(arms), int(stars)))
+    return jobs
+
+def run_batch(settings: Settings, jobs: list[tuple[int, int, str, int, int]], output_dir: str) -> list[dict[str, Any]]:
+    # Nobody is watching, never open an image viewer
+    settings = copy.copy(settings)
+    settings.export = replace(settings.export, show=False)
+    report = []
+    batch_start = time.time()
+    # One pool for the whole batch, workers keep their imports between jobs
+    executor = worker_pool(settings)
+    try:
+        for index, (seed, size, galaxy_type, arms, num_stars) in enumerate(jobs):
+            job_dir = os.path.join(output_dir, f"{index:04d}_{seed}")
+            entry: dict[str, Any] = {"index": index, "seed": seed, "size": size, "type": galaxy_type, "arms": arms, "stars": num_stars, "output": job_dir}
+            start_time = time.time()
+            try:
+                results = generate_galaxy(settings, size, galaxy_type, arms, num_stars, seed, executor, job_dir)
+            except Exception as e:
+                # A failed job is reported and the batch goes on, bad parameters raise ValueError
+                entry["error"] = str(e) if isinstance(e, ValueError) else f"{type(e).__name__}: {e}"
+                print(f"[{index + 1}/{len(jobs)}] {job_dir}: {entry['error']}")
+                if isinstance(e, BrokenExecutor):
+                    # A worker died and took the pool with it
+                    executor.shutdown()
+                    executor = worker_pool(settings)
+            else:
+                entry["time"] = round(time.time() - start_time, 3)
+                entry["stages"] = {name: "cached" if result.cached else round(result.time, 3) if result.time else None for name, result in results.items()}
+                print(f"[{index + 1}/{len(jobs)}] {job_dir}: {entry['time']}s")
+            report.append(entry)
+    finally:
+        executor.shutdown()
+
+    done = [entry for entry in report if "error" not in entry]
+    total_time = time.time() - batch_start
+    print(f"Rendered {len(done)}/{len(jobs)} galaxies in {round(total_time, 2)}s"
+          + (f" ({round(total_time / len(done), 2)}s per galaxy)" if done else ""))
+    return report
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Galaxy generator")
+    parser.add_argument("--settings", default="settings.hjson", help="settings file to use")
+    parser.add_argument("--batch", metavar="FILE", help="render every job in FILE ('-' for stdin) without prompts or viewer")
+    parser.add_argument("--output-dir", default=".", help="batch jobs are written to OUTPUT_DIR/<index>_<seed>/")
+    parser.add_argument("--report", metavar="FILE", help="write per-job timings of a batch as JSON")
+    parser.add_argument("--preview", type=int, metavar="N", help="save galaxy_preview.png at 1/N of the size before the full render")
+    parser.add_argument("--preview-only", action="store_true", help="stop after the preview")
+    return parser.parse_args()
 
 if __name__ == "__main__":
     multiprocessing.freeze_support()
-    settings = load_settings()
+    args = parse_args()
+    settings = load_settings(args.settings)
+
+    if args.batch:
+        if args.batch == "-":
+            jobs = read_jobs(sys.stdin)
+        else:
+            with open(args.batch, "r") as f:
+                jobs = read_jobs(f)
+        report = run_batch(settings, jobs, args.output_dir)
+        if args.report:
+            with open(args.report, "w") as f:
+                json.dump(report, f, indent=2)
+        sys.exit(1 if any("error" in entry for entry in report) else 0)
 
     if settings.manual:
         size = int(input("> Size of image in pixel? "))
@@ -107,5 +356,23 @@ if __name__ == "__main__":
         arms = settings.parameters.arms
         stars = settings.parameters.stars
         type = settings.parameters.type
+    seed = settings.parameters.seed if settings.parameters.seed is not None else random_seed()
+    preview = args.preview if args.preview is not None else settings.parameters.preview
+    preview_only = args.preview_only or settings.parameters.preview_only
+
+    start_time = time.time()
+    print("Working...")
+    # Preview and full render share the worker pool, so the full render starts warm
+    with worker_pool(settings) as executor:
+        try:
+            if preview:
+                preview_size, results = generate_preview(settings, size, type, arms, stars, seed, preview, executor)
+                print(f"Saved {preview_size}x{preview_size} preview as {results['png'].data[0] if results['png'].data else '[skipped]'} in {round(time.time() - start_time, 2)}s")
+            if not (preview and preview_only):
+                results = generate_galaxy(settings, size, type, arms, stars, seed, executor)
+                print_summary(results, size, stars, seed, time.time() - start_time)
+        except ValueError as e:
+            print(e)
 
-    generate_galaxy(settings, size, type, arms, stars)
\ No newline at end of file
+    print("This window will close in 10 seconds.")
+    time.sleep(10)
@@ -6,7 +6,12 @@ a = Analysis(
     pathex=[],
     binaries=[],
     datas=[],
-    hiddenimports=[],
+    # Imported by name when the worker processes start, see worker_modules() in main.py
+    hiddenimports=[
+        'src.generate_background', 'src.generate_spirals', 'src.generate_nebula', 'src.generate_dust',
+        'src.generate_stars', 'src.generate_hyperlanes', 'src.export_zip', 'src.export_graph', 'src.export_catalog',
+        'src.export_tiles', 'scipy.spatial',
+    ],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
@@ -0,0 +1,37 @@
+import os
+import time
+import numpy as np
+from PIL import Image
+from src.generate_stars import STAR_CLASSES, STAR_SHAPES
+from src.utils.settings import Settings
+from src.utils.result_obj import Result
+
+CATALOG_FORMATS = ("npy", "npz")
+
+def check_catalog(settings: Settings) -> None:
+    catalog_format = settings.export.star_catalog
+    if catalog_format and catalog_format not in CATALOG_FORMATS:
+        raise ValueError(f"Unknown star catalog format '{catalog_format}'")
+
+def export_star_catalog(settings: Settings, stars: Result, output_dir: str=".") -> Result:
+    catalog_format = settings.export.star_catalog
+    if not (catalog_format and settings.steps.stars and stars.data):
+        return Result(None, Image.new("RGBA", (1, 1), (0, 0, 0, 0)))
+    check_catalog(settings)
+
+    start_time = time.time()
+    # Rows are sorted by x, then y
+    catalog = stars.data[0].catalog
+    if catalog_format == "npy":
+        # One structured array, np.load() reads it without pickle
+        np.save(os.path.join(output_dir, "galaxy_stars.npy"), catalog)
+    else:
+        # One array per column plus the tables spectral and shape index into
+        np.savez(
+            os.path.join(output_dir, "galaxy_stars.npz"),
+            **{name: catalog[name] for name in catalog.dtype.names},
+            spectral_classes=np.array([name for name, _ in STAR_CLASSES]),
+            spectral_colors=np.array([color for _, color in STAR_CLASSES], dtype=np.uint8),
+            shapes=np.array([shape for shape, _ in STAR_SHAPES]),
+        )
+    return Result(start_time, Image.new("RGBA", (1, 1), (0, 0, 0, 0)))
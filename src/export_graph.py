@@ -0,0 +1,24 @@
+import json
+import os
+import time
+import numpy as np
+from PIL import Image
+from src.utils.settings import Settings
+from src.utils.result_obj import Result
+
+def export_hyperlane_graph(settings: Settings, hyperlane: Result, output_dir: str=".") -> Result:
+    if not (settings.export.graph and settings.steps.hyperlanes and hyperlane.data):
+        return Result(None, Image.new("RGBA", (1, 1), (0, 0, 0, 0)))
+
+    start_time = time.time()
+    # Nodes are star positions in px, every edge row holds two indices into nodes
+    nodes, edges = hyperlane.data
+    nodes = nodes.astype(np.int32)
+    edges = edges.astype(np.int32)
+    np.savez(os.path.join(output_dir, "galaxy_hyperlanes.npz"), nodes=nodes, edges=edges)
+
+    if settings.export.graph_json:
+        with open(os.path.join(output_dir, "galaxy_hyperlanes.json"), "w") as f:
+            json.dump({"nodes": nodes.tolist(), "edges": edges.tolist()}, f, separators=(",", ":"))
+
+    return Result(start_time, Image.new("RGBA", (1, 1), (0, 0, 0, 0)))
@@ -1,32 +1,136 @@
+import os
 import time
 from PIL import Image
 from src.utils.settings import Settings
 from src.utils.result_obj import Result
+from src.utils.layer_store import LayerFile
+from src.utils.image_formats import image_extension, is_headless, write_image
+from src.utils import telemetry
+from src.utils.tiles import band_boxes
 
-def export_as_png(settings: Settings, size: int, background: Result, arm_1: Result, arm_2: Result, arm_3: Result, arm_4: Result, arm_5: Result, nebula: Result, hyperlane: Result, stars: Result, dust: Result) -> Result:
-    if not settings.export.png:
-        return Result(None, Image.new("RGBA", (1, 1), (0, 0, 0, 0)))
-
-    comp_time = time.time()
-    img = background.image
-
-    if settings.steps.spirals:
-        img.alpha_composite(arm_1.image, (0, 0))
-        img.alpha_composite(arm_2.image, (0, 0))
-        img.alpha_composite(arm_3.image, (0, 0))
-        img.alpha_composite(arm_4.image, (0, 0))
-        img.alpha_composite(arm_5.image, (0, 0))
-    if settings.steps.nebula:
-        img.alpha_composite(nebula.image, (0, 0))
-    if settings.steps.hyperlanes and settings.steps.stars:
-        img.alpha_composite(hyperlane.image, (0, 0))
-    if settings.steps.stars:
-        img.alpha_composite(stars.image, (0, 0))
-
-    if settings.steps.dust:
-        dust_layer = Image.new("RGBA", (size, size), (15, 10, 5, 255))
-        img.paste(dust_layer, (0, 0), mask=dust.image)
-
-    img.save("galaxy.png", "PNG")
-    img.show()
-    return Result(comp_time, Image.new("RGBA", (1, 1), (0, 0, 0, 0)))
\ No newline at end of file
+# Rows per encoded band when the layers aren't tiled
+EXPORT_BAND_ROWS = 256
+
+# Z-order of the layers in the final image, bottom first
+COMPOSITE_ORDER = ("background", "arm_1", "arm_2", "arm_3", "arm_4", "arm_5", "h2_nebula", "hyperlanes", "stars", "dust_nebula")
+
+def read_layer(result: Result, box: tuple[int, int, int, int]) -> Image.Image:
+    if isinstance(result.image, LayerFile):
+        return result.image.read_image(box)
+    if box == (0, 0) + result.image.size:
+        return result.image
+    return result.image.crop(box)
+
+def fold_layer(img: Image.Image, name: str, layer: Image.Image) -> Image.Image:
+    if name == "dust_nebula":
+        dust_layer = Image.new("RGBA", img.size, (15, 10, 5, 255))
+        img.paste(dust_layer, (0, 0), mask=layer)
+    else:
+        img.alpha_composite(layer, (0, 0))
+    return img
+
+class Compositor:
+    """Folds layers into the final image in z-order while the others are still rendering.
+
+    Layers that arrive early wait until everything below them has been folded
+    in, each layer is released right after it has been applied.
+    """
+    def __init__(self, settings: Settings, size: int):
+        self.settings = settings
+        self.size = size
+        self.order = [name for name in COMPOSITE_ORDER if self.is_enabled(name)] if settings.export.png else []
+        self.waiting: dict[str, Result] = {}
+        self.folded = 0
+        self.canvas: Image.Image|LayerFile|None = None
+        self.elapsed = 0.0
+
+    def is_enabled(self, name: str) -> bool:
+        steps = self.settings.steps
+        match name:
+            case "background":
+                return True
+            case "h2_nebula":
+                return steps.nebula
+            case "hyperlanes":
+                return steps.hyperlanes and steps.stars
+            case "stars":
+                return steps.stars
+            case "dust_nebula":
+                return steps.dust
+            case _:
+                return steps.spirals
+
+    @property
+    def done(self) -> bool:
+        return self.folded == len(self.order)
+
+    def add(self, name: str, result: Result) -> None:
+        if name not in self.order:
+            return
+        start_time = time.time()
+        self.waiting[name] = result
+        while not self.done and self.order[self.folded] in self.waiting:
+            layer_name = self.order[self.folded]
+            with telemetry.span(f"composite_{layer_name}"):
+                self.fold(layer_name, self.waiting.pop(layer_name))
+            self.folded += 1
+        self.elapsed += time.time() - start_time
+
+    def fold(self, name: str, result: Result) -> None:
+        if isinstance(result.image, LayerFile):
+            # Tiled layers are folded band by band into a canvas layer file
+            if self.canvas is None:
+                self.canvas = LayerFile.create(self.size, "RGBA")
+            for box in band_boxes(self.size, self.settings.performance.tile_size):
+                if name == "background":
+                    self.canvas.write(box, read_layer(result, box))
+                else:
+                    self.canvas.write(box, fold_layer(self.canvas.read_image(box), name, read_layer(result, box)))
+            result.close()
+            return
+
+        if name == "background":
+            self.canvas = result.image
+        else:
+            self.canvas = fold_layer(self.canvas, name, result.image) # type: ignore
+        result.release()
+
+    def close(self) -> None:
+        # The canvas and the waiting layers can be views of the run's layer files
+        if isinstance(self.canvas, LayerFile):
+            self.canvas.close()
+        self.canvas = None
+        for result in self.waiting.values():
+            result.close()
+        self.waiting.clear()
+
+    def save(self, output_dir: str=".", name: str="galaxy") -> Result:
+        if not self.order:
+            return Result(None, Image.new("RGBA", (1, 1), (0, 0, 0, 0)))
+        if not self.done:
+            raise RuntimeError(f"Layer '{self.order[self.folded]}' was never composited")
+
+        start_time = time.time()
+        export = self.settings.export
+        path = os.path.join(output_dir, name + image_extension(export.format))
+        canvas = self.canvas
+        if isinstance(canvas, LayerFile):
+            # Stream the canvas into the file one band of rows at a time
+            canvas.flush()
+            read_box, band_rows = canvas.read_image, self.settings.performance.tile_size
+        else:
+            read_box, band_rows = canvas.crop, EXPORT_BAND_ROWS # type: ignore
+        with open(path, "wb") as fp:
+            write_image(fp, self.size, "RGBA", read_box, band_rows, export, self.settings.performance.workers or os.cpu_count() or 1)
+        if export.show and not is_headless() and isinstance(canvas, Image.Image):
+            canvas.show()
+
+        result = Result(None, Image.new("RGBA", (1, 1), (0, 0, 0, 0)), path)
+        result.time = self.elapsed + time.time() - start_time
+        return result
+
+def export_as_png(settings: Settings, size: int, background: Result, arm_1: Result, arm_2: Result, arm_3: Result, arm_4: Result, arm_5: Result, nebula: Result, hyperlane: Result, stars: Result, dust: Result, output_dir: str=".") -> Result:
+    compositor = Compositor(settings, size)
+    for name, result in zip(COMPOSITE_ORDER, (background, arm_1, arm_2, arm_3, arm_4, arm_5, nebula, hyperlane, stars, dust)):
+        compositor.add(name, result)
+    return compositor.save(output_dir)
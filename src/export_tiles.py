@@ -0,0 +1,125 @@
+import math
+import os
+import time
+from concurrent.futures import Executor, Future
+from PIL import Image
+from src.utils.settings import Settings
+from src.utils.result_obj import Result
+from src.utils.layer_store import LayerFile
+from src.utils.scheduler import cancel_futures
+
+TILE_FORMATS = {"png": ("PNG", ".png"), "webp": ("WEBP", ".webp"), "jpeg": ("JPEG", ".jpg")}
+DEEPZOOM_OVERLAP = 1
+# Rows of the next level every reduction job writes
+REDUCE_ROWS = 512
+
+def pyramid_depth(size: int, tile_size: int, layout: str) -> int:
+    # Levels below the full size one. XYZ stops once the image fits into one
+    # tile, DeepZoom keeps halving down to a single pixel
+    match layout:
+        case "xyz":
+            return max(0, math.ceil(math.log2(size / tile_size)))
+        case "deepzoom":
+            return math.ceil(math.log2(size)) if size > 1 else 0
+        case _:
+            raise ValueError(f"Unknown tile layout '{layout}'")
+
+def check_tiles(settings: Settings, size: int) -> None:
+    export = settings.export
+    if export.tiles:
+        pyramid_depth(size, export.map_tile_size, export.tiles)
+        if not export.png:
+            raise ValueError("Tile pyramids are cut from the composited image, they need export.png")
+        if export.tile_format not in TILE_FORMATS:
+            raise ValueError(f"Unknown tile format '{export.tile_format}'")
+
+def reduce_rows(source: LayerFile, target: LayerFile, top: int, bottom: int) -> None:
+    # Every pixel of the next level averages 2 x 2 pixels of this one, PIL
+    # premultiplies alpha for that like a viewer would when zooming out
+    band = source.read_image((0, 2 * top, source.size, min(2 * bottom, source.size)))
+    target.write((0, top, target.size, bottom), band.reduce(2))
+
+def tile_path(output_dir: str, layout: str, level: int, x: int, y: int, extension: str) -> str:
+    if layout == "xyz":
+        return os.path.join(output_dir, "tiles", str(level), str(x), f"{y}{extension}")
+    return os.path.join(output_dir, "galaxy_files", str(level), f"{x}_{y}{extension}")
+
+def write_tile_row(level_image: LayerFile, level_size: int, output_dir: str, layout: str, level: int, row: int, tile_size: int, tile_format: str) -> int:
+    # Rows of tiles are the unit of work, every one reads its band once
+    format, extension = TILE_FORMATS[tile_format]
+    overlap = DEEPZOOM_OVERLAP if layout == "deepzoom" else 0
+    top = max(0, row * tile_size - overlap)
+    bottom = min(level_size, (row + 1) * tile_size + overlap)
+    band = level_image.read_image((0, top, level_size, bottom))
+
+    written = 0
+    for x in range(math.ceil(level_size / tile_size)):
+        left = max(0, x * tile_size - overlap)
+        right = min(level_size, (x + 1) * tile_size + overlap)
+        tile = band.crop((left, 0, right, bottom - top))
+        if layout == "xyz" and tile.size != (tile_size, tile_size):
+            # Slippy maps expect square tiles, the edge of the galaxy is padded
+            padded = Image.new("RGBA", (tile_size, tile_size), (0, 0, 0, 0))
+            padded.paste(tile, (0, 0))
+            tile = padded
+        if format == "JPEG":
+            tile = tile.convert("RGB")
+
+        path = tile_path(output_dir, layout, level, x, row, extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tile.save(path, format)
+        written += 1
+    return written
+
+def write_deepzoom_descriptor(output_dir: str, size: int, tile_size: int, extension: str) -> None:
+    with open(os.path.join(output_dir, "galaxy.dzi"), "w") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write(f'<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="{extension[1:]}" Overlap="{DEEPZOOM_OVERLAP}" TileSize="{tile_size}">\n')
+        f.write(f'    <Size Width="{size}" Height="{size}"/>\n')
+        f.write('</Image>\n')
+
+def export_pyramid(settings: Settings, size: int, canvas: Image.Image|LayerFile|None, executor: Executor, output_dir: str=".") -> Result:
+    """Cuts the composited galaxy into a tile pyramid for zoomable viewers.
+
+    Every level is reduced from the one below it into a layer file, the rows
+    of tiles of a level are written by the executor while the next level is
+    being reduced.
+    """
+    export = settings.export
+    if not export.tiles or canvas is None:
+        return Result(None, Image.new("RGBA", (1, 1), (0, 0, 0, 0)))
+    check_tiles(settings, size)
+
+    start_time = time.time()
+    layout, tile_size = export.tiles, export.map_tile_size
+    depth = pyramid_depth(size, tile_size, layout)
+    level_image = canvas if isinstance(canvas, LayerFile) else LayerFile.from_image(canvas)
+    level_size = size
+
+    written: list[Future] = []
+    reductions: list[Future] = []
+    try:
+        for step in range(depth + 1):
+            # Both layouts number their levels from the top of the pyramid
+            level = depth - step
+            level_image.flush()
+            written.extend(executor.submit(write_tile_row, level_image, level_size, output_dir, layout, level, row, tile_size, export.tile_format)
+                           for row in range(math.ceil(level_size / tile_size)))
+            if step == depth:
+                break
+
+            next_image = LayerFile.create(-(-level_size // 2), "RGBA")
+            reductions = [executor.submit(reduce_rows, level_image, next_image, top, min(top + REDUCE_ROWS, next_image.size))
+                          for top in range(0, next_image.size, REDUCE_ROWS)]
+            for future in reductions:
+                future.result()
+            level_image, level_size = next_image, next_image.size
+
+        tiles = sum(future.result() for future in written)
+    except BaseException:
+        # Queued rows would read levels the run is about to delete
+        cancel_futures([*written, *reductions])
+        raise
+    if layout == "deepzoom":
+        write_deepzoom_descriptor(output_dir, size, tile_size, TILE_FORMATS[export.tile_format][1])
+    return Result(start_time, Image.new("RGBA", (1, 1), (0, 0, 0, 0)), tiles, depth + 1)
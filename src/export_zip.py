@@ -1,11 +1,14 @@
-import io
+import os
 import zipfile
 import time
 from PIL import Image
 from src.utils.settings import Settings
+from src.utils import telemetry
 from src.utils.result_obj import Result
+from src.utils.image_formats import image_extension, write_image
+from src.export_png import EXPORT_BAND_ROWS, read_layer
 
-def export_as_zip(settings: Settings, size: int, background: Result, arm_1: Result, arm_2: Result, arm_3: Result, arm_4: Result, arm_5: Result, nebula: Result, hyperlane: Result, stars: Result, dust: Result) -> Result:
+def export_as_zip(settings: Settings, size: int, background: Result, arm_1: Result, arm_2: Result, arm_3: Result, arm_4: Result, arm_5: Result, nebula: Result, hyperlane: Result, stars: Result, dust: Result, output_dir: str=".") -> Result:
     if not settings.export.zip:
         return Result(None, Image.new("RGBA", (1, 1), (0, 0, 0, 0)))
 
@@ -15,31 +18,40 @@ def export_as_zip(settings: Settings, size: int, background: Result, arm_1: Resu
     if settings.steps.spirals:
         # Adding arms individually or as a group
         for i, arm in enumerate([arm_1, arm_2, arm_3, arm_4, arm_5], 1):
-            layers_to_export[f"01_arm_{i}.png"] = arm.image
+            layers_to_export[f"01_arm_{i}.png"] = arm
 
     if settings.steps.nebula:
-        layers_to_export["02_h2_nebula.png"] = nebula.image
+        layers_to_export["02_h2_nebula.png"] = nebula
 
     if settings.steps.hyperlanes and settings.steps.stars:
-        layers_to_export["03_hyperlanes.png"] = hyperlane.image
+        layers_to_export["03_hyperlanes.png"] = hyperlane
 
     if settings.steps.stars:
-        layers_to_export["04_stars.png"] = stars.image
-
+        layers_to_export["04_stars.png"] = stars
+
+    def dust_box(box: tuple[int, int, int, int]) -> Image.Image:
+        width, height = box[2] - box[0], box[3] - box[1]
+        dust_layer = Image.new("RGBA", (width, height), (15, 10, 5, 255))
+        exported_dust = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+        exported_dust.paste(dust_layer, (0, 0), mask=read_layer(dust, box))
+        return exported_dust
+
+    sources = {"00_background.png": lambda box: read_layer(background, box)}
+    for filename, layer in layers_to_export.items():
+        sources[filename] = lambda box, layer=layer: read_layer(layer, box)
     if settings.steps.dust:
-        dust_layer = Image.new("RGBA", (size, size), (15, 10, 5, 255))
-        exported_dust = Image.new("RGBA", (size, size), (0, 0, 0, 0))
-        exported_dust.paste(dust_layer, (0, 0), mask=dust.image)
-        layers_to_export["05_dust.png"] = exported_dust
-
-    with zipfile.ZipFile("galaxy_layers.zip", "w") as zf:
-        img_byte_arr = io.BytesIO()
-        background.image.save(img_byte_arr, format='PNG')
-        zf.writestr("00_background.png", img_byte_arr.getvalue(), compresslevel=3)
-
-        # Loop through the generated layers
-        for filename, layer_img in layers_to_export.items():
-            img_byte_arr = io.BytesIO()
-            layer_img.save(img_byte_arr, format='PNG')
-            zf.writestr(filename, img_byte_arr.getvalue())
-    return Result(comp_time, Image.new("RGBA", (1, 1), (0, 0, 0, 0)))
\ No newline at end of file
+        sources["05_dust.png"] = dust_box
+
+    # Layers are streamed band by band into their entries where the format
+    # allows. They are either compressed already or raw dumps meant to be
+    # mapped, so the entries are stored as they are
+    export = settings.export
+    extension = image_extension(export.format)
+    band_rows = settings.performance.tile_size or EXPORT_BAND_ROWS
+    threads = settings.performance.workers or os.cpu_count() or 1
+    with zipfile.ZipFile(os.path.join(output_dir, "galaxy_layers.zip"), "w", zipfile.ZIP_STORED) as zf:
+        for filename, source in sources.items():
+            with zf.open(filename.removesuffix(".png") + extension, "w", force_zip64=True) as entry:
+                write_image(entry, size, "RGBA", source, band_rows, export, threads)
+            telemetry.count("bytes_written", zf.getinfo(filename.removesuffix(".png") + extension).file_size)
+    return Result(comp_time, Image.new("RGBA", (1, 1), (0, 0, 0, 0)))
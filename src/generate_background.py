@@ -1,35 +1,70 @@
 import time
-import random
-import math
+import numpy as np
 from src.utils.result_obj import Result
+from src.utils.layer_store import LayerFile
+from src.utils.particles import Particles, render_particles
 from src.utils.settings import Settings
-from PIL import Image, ImageDraw, ImageFilter
+from src.utils.blur import Blur
+from src.utils.tiles import render_band, render_tiled
+from src.utils import telemetry
+from PIL import Image, ImageDraw
 
-def generate_background(settings: Settings, size: int, center: int) -> Result:
-    start_time = time.time()
-    bk = Image.new("RGBA", (size, size), (0, 0, 0, 255))
-    core_glow = Image.new("RGBA", (size, size), (0, 0, 0, 0))
-    draw = ImageDraw.Draw(core_glow)
+def glow_rings(size: int) -> range:
+    return range(size // 10, 0, -2)
+
+def glow_alpha(size: int, r: int) -> int:
+    return int(100 * (1 - r / (size // 10)))
 
+def draw_core_glow(draw: ImageDraw.ImageDraw, size: int, center: int, origin: tuple[int, int]=(0, 0)) -> None:
     # Draw multiple concentric circles with decreasing opacity
-    for r in range(size // 10, 0, -2):
-        alpha = int(100 * (1 - r / (size // 10)))
-        draw.ellipse([center-r, center-r, center+r, center+r], fill=(255, 240, 200, min(alpha*2,255)))
+    cx = center - origin[0]
+    cy = center - origin[1]
+    for r in glow_rings(size):
+        alpha = glow_alpha(size, r)
+        draw.ellipse([cx-r, cy-r, cx+r, cy+r], fill=(255, 240, 200, min(alpha*2,255)))
 
+def disk_particles(rng: np.random.Generator, size: int, center: int, alpha: int) -> Particles:
     # Disk is big
     nebula_count = 50000 * size * size // (2000 * 2000)
     radius = size / 2
-    for _ in range(nebula_count):
-        theta = random.random() * 2 * math.pi
-        r = radius * random.random() ** 0.7
-        x = center + r * math.cos(theta)
-        y = center + r * math.sin(theta)
+    theta = rng.random(nebula_count) * 2 * np.pi
+    r = radius * rng.random(nebula_count) ** 0.7
+    x = center + r * np.cos(theta)
+    y = center + r * np.sin(theta)
 
-        if 0 <= x < size and 0 <= y < size:
-            draw.circle([x, y], radius=5, fill=(150, 160, 200, int(alpha/10)))  # type: ignore
+    inside = (0 <= x) & (x < size) & (0 <= y) & (y < size)
+    fill = np.tile(np.array([150, 160, 200, int(alpha/10)], dtype=np.uint8), (nebula_count, 1))
+    telemetry.count("particles_drawn", nebula_count)
+    return Particles(x, y, np.full(nebula_count, 5), fill).subset(inside)
 
+def render_background(size: int, center: int, particles: Particles, backend: str, blur: Blur, box: tuple[int, int, int, int]) -> Image.Image:
+    width, height = box[2] - box[0], box[3] - box[1]
+    bk = Image.new("RGBA", (width, height), (0, 0, 0, 255))
+    core_glow = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    draw_core_glow(ImageDraw.Draw(core_glow), size, center, (box[0], box[1]))
+    render_particles(core_glow, particles.in_box(box), backend, origin=(box[0], box[1]), blur_radius=blur.radius)
 
     bk.alpha_composite(core_glow)
-    bk = bk.filter(ImageFilter.GaussianBlur(radius=size//100))
+    return blur.apply(bk, (box[0], box[1]))
+
+def generate_background(settings: Settings, size: int, center: int, seed: np.random.SeedSequence, band: tuple[LayerFile, tuple[int, int, int, int]]|None=None) -> Result:
+    start_time = time.time()
+
+    # The disk reuses the opacity of the innermost glow ring
+    rings = glow_rings(size)
+    alpha = glow_alpha(size, rings[-1]) if rings else 0
+    rng = np.random.default_rng(seed)
+    particles = disk_particles(rng, size, center, alpha)
+    telemetry.count("particles_accepted", len(particles))
+
+    blur = Blur("gaussian", size//100, settings.performance.blur_engine)
+    backend = settings.performance.particle_backend
+    tile_size = settings.performance.tile_size
+    if band is not None:
+        bk = render_band(band, tile_size, blur.halo + particles.reach, lambda box: render_background(size, center, particles, backend, blur, box))
+    elif tile_size:
+        bk = render_tiled(size, "RGBA", tile_size, blur.halo + particles.reach, lambda box: render_background(size, center, particles, backend, blur, box))
+    else:
+        bk = render_background(size, center, particles, backend, blur, (0, 0, size, size))
 
-    return Result(start_time, bk)
\ No newline at end of file
+    return Result(start_time, bk, particles=len(particles))
@@ -1,35 +1,43 @@
-import math
-import random
 import time
-from PIL import Image, ImageDraw, ImageFilter
+import numpy as np
+from PIL import Image
 from src.utils.settings import Settings, GalaxyType
 from src.utils.result_obj import Result
+from src.utils.layer_store import LayerFile
+from src.utils.particles import Particles, render_particle_layer
+from src.utils.functions import spiral_coordinates
+from src.utils.blur import Blur
+from src.utils import telemetry
 
-def generate_dust_lanes(settings: Settings, galaxy_config: GalaxyType, center: int, scale: float, size: int, arms: int) -> Result:
-    if not settings.steps.dust:
-        return Result(None, Image.new("RGBA", (1, 1), (0, 0, 0, 0)))
-
-    start_time = time.time()
-    dust_mask = Image.new("L", (size, size), 0)
-    draw = ImageDraw.Draw(dust_mask)
-
+def dust_particles(rng: np.random.Generator, settings: Settings, galaxy_config: GalaxyType, center: int, scale: float, size: int, arms: int) -> Particles:
     amount_factor = settings.generation.dust.amount_factor
 
     dust_particles = int(amount_factor * size * size // (2000 * 2000))
-    for _ in range(dust_particles):
-        arm_index = random.randint(0, arms - 1)
-        r = random.uniform(1.5, 12.0)
-        theta_offset = -0.5
-        theta = (1.0 / galaxy_config.tightness) * math.log(r + 0.1)
-        theta += arm_index * 2 * math.pi / arms + theta_offset + random.gauss(0, 0.1)
+    arm_index = rng.integers(0, arms, dust_particles)
+    r = rng.uniform(1.5, 12.0, dust_particles)
+    # Lanes trail the arms a little
+    theta_offset = -0.5
+    px, py = spiral_coordinates(galaxy_config, arms, arm_index, r, scale, center, theta_offset + rng.normal(0, 0.1, dust_particles))
 
-        px = int(center + (r * math.cos(theta) * scale))
-        py = int(center + (r * math.sin(theta) * scale))
+    rad = np.where(rng.random(dust_particles) > 0.2, rng.integers(1, 4, dust_particles), rng.integers(4, 9, dust_particles))
+    opacity = rng.integers(20, 181, dust_particles)
 
-        if 0 <= px < size and 0 <= py < size:
-            rad = random.randint(1, 3) if random.random() > 0.2 else random.randint(4, 8)
-            opacity = random.randint(20, 180)
-            draw.ellipse([px-rad, py-rad, px+rad, py+rad], fill=opacity)
+    inside = (0 <= px) & (px < size) & (0 <= py) & (py < size)
+    telemetry.count("particles_drawn", len(px))
+    return Particles(px, py, rad, opacity[:, None].astype(np.uint8)).subset(inside)
+
+def generate_dust_lanes(settings: Settings, galaxy_config: GalaxyType, center: int, scale: float, size: int, arms: int, seed: np.random.SeedSequence, band: tuple[LayerFile, tuple[int, int, int, int]]|None=None) -> Result:
+    if not settings.steps.dust:
+        return Result(None, Image.new("RGBA", (1, 1), (0, 0, 0, 0)))
+
+    start_time = time.time()
+    rng = np.random.default_rng(seed)
+    particles = dust_particles(rng, settings, galaxy_config, center, scale, size, arms)
+    telemetry.count("particles_accepted", len(particles))
 
-    dust_mask = dust_mask.filter(ImageFilter.BoxBlur(radius=size//100))
-    return Result(start_time, dust_mask)
\ No newline at end of file
+    blur_radius = size//100
+    dust_mask = render_particle_layer(
+        size, "L", particles, settings.performance.particle_backend, Blur("box", blur_radius, settings.performance.blur_engine),
+        settings.performance.tile_size, band
+    )
+    return Result(start_time, dust_mask, particles=len(particles))
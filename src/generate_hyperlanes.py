@@ -1,181 +1,163 @@
-import random
 import time
+from typing import TYPE_CHECKING
 import numpy as np
-from typing import Any
-from scipy.spatial import KDTree
-from PIL import Image, ImageDraw
+from PIL import Image
 from src.utils.settings import Settings, GalaxyType
 from src.utils.result_obj import Result
-from src.utils.functions import get_random_coordinate_on_spiral
-
-cluster_chance = 0
-branch_chance = 0
-step_size = 0
-hyperlane_max_length = 0
-
-def draw_hyperlane(draw: ImageDraw.ImageDraw, origin: tuple[int, int], destination: tuple[int, int], tree: KDTree, star_array: np.ndarray[Any], hyperlane_condition):
-    current_point = origin
-    path = [origin]
-
-    steps = 8
-    dx = (destination[0] - origin[0]) / steps
-    dy = (destination[1] - origin[1]) / steps
-
-    for i in range(1, steps + 1):
-        i_x = origin[0] + dx * i
-        i_y = origin[1] + dy * i
-
-        dist, index = tree.query([i_x, i_y])
-        found_star = tuple(star_array[index])
-
-        if dist <= hyperlane_max_length:
-            draw.circle(found_star, 2, fill=(120, 180, 255, 150))
-            if random.random() < hyperlane_condition:
-                draw.line([current_point, found_star], fill=(120, 180, 255, 150), width=2)
-
-            current_point = found_star
-            path.append(found_star)
-
-            # If we reached the actual destination star, we're done early
-            if np.array_equal(found_star, destination):
-                break
-        else:
-            # If a single link in the chain is too long, the path breaks
-            break
-
-def generate_side_cluster(draw: ImageDraw.ImageDraw, settings: Settings, galaxy_config: GalaxyType, tree: KDTree, star_array: np.ndarray[Any], origin: tuple[int, int]):
-    global step_size
-
-    cluster_size_factor = settings.generation.hyperlanes.cluster_size_factor
-    cluster_size_alpha = settings.generation.hyperlanes.cluster_size_alpha
-    cluster_size_beta = settings.generation.hyperlanes.cluster_size_beta
-
-    cluster_size = int(random.betavariate(cluster_size_alpha, cluster_size_beta) * cluster_size_factor)
-    nearby_stars = tree.query_ball_point(origin, r=hyperlane_max_length)
-    random.shuffle(nearby_stars)
-
-    for star in nearby_stars[:cluster_size]:
-        c_star = tuple(star_array[star])
-
-        if c_star != origin:
-            draw_hyperlane(draw, origin, c_star, tree, star_array, 1)
-
-def generate_side_hyperlane(draw: ImageDraw.ImageDraw, settings: Settings, galaxy_config: GalaxyType, tree: KDTree, star_array: np.ndarray[Any], origin: tuple[int, int], main_drift: float, arms: int, arm_index: int, scale: float, center: int, branch_r: float):
-    global step_size
-
-    branch_length_factor = settings.generation.hyperlanes.branch_length_factor
-    branch_length_alpha = settings.generation.hyperlanes.branch_length_alpha
-    branch_length_beta = settings.generation.hyperlanes.branch_length_beta
-    branch_drift_mu = settings.generation.hyperlanes.branch_drift_mu
-    branch_drift_sigma = settings.generation.hyperlanes.branch_drift_sigma
-
-    branch_length = int(random.betavariate(branch_length_alpha, branch_length_beta) * branch_length_factor)
-    branch_drift = random.normalvariate(branch_drift_mu, branch_drift_sigma) + main_drift
-    branch_path = [origin]
-
-    fragmentation = settings.generation.fragmentation.small_hyperlanes
-
-    break_chance_min = settings.generation.hyperlanes.break_chance_max
-    break_chance_min = settings.generation.hyperlanes.break_chance_min
-    hyperlane_condition = 1- random.uniform(break_chance_min, break_chance_min)
-
-    for _ in range(branch_length):
-        branch_r += step_size
-        bx, by = get_random_coordinate_on_spiral(galaxy_config, arms, arm_index, branch_r, scale, center, fragmentation=fragmentation, drift=branch_drift)
-        b_dist, b_index = tree.query([bx, by])
-
-        if b_dist < hyperlane_max_length:
-            b_star = tuple(star_array[b_index])
-            if b_star != branch_path[-1]:
-                draw_hyperlane(draw, branch_path[-1], b_star, tree, star_array, hyperlane_condition)
-                branch_path.append(b_star)
-
-
-def generate_main_hyperlane(draw: ImageDraw.ImageDraw, settings: Settings, galaxy_config: GalaxyType, tree: KDTree, star_array: np.ndarray[Any], arms: int, arm_index: int, scale: float, center: int):
-    global cluster_chance, branch_chance, step_size
+from src.utils.spatial_index import StarIndex
+from src.utils.functions import get_random_coordinates_on_spiral
+from src.utils.tiles import DrawRecorder, render_tiled
+from src.utils import telemetry
+
+if TYPE_CHECKING:
+    from scipy.spatial import KDTree
+
+LANE_COLOR = (120, 180, 255, 150)
+LINK_STEPS = 8
+
+def nearest_stars(tree: "KDTree", points: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    if len(points) == 0:
+        return np.zeros(0), np.zeros(0, dtype=np.int64)
+    telemetry.count("kdtree_calls")
+    telemetry.count("kdtree_queries", len(points))
+    return tree.query(points, workers=-1)
+
+def walk_links(tree: "KDTree", star_array: np.ndarray, origins: np.ndarray, destinations: np.ndarray, conditions: np.ndarray, rolls: np.ndarray, max_length: float) -> tuple[np.ndarray, np.ndarray]:
+    # Every link hops over the stars nearest to LINK_STEPS evenly spaced points
+    # between its ends. A hop longer than max_length breaks the link, reaching
+    # the destination ends it, and each hop only becomes an edge with the
+    # link's condition as probability
+    steps = np.arange(1, LINK_STEPS + 1) / LINK_STEPS
+    start = star_array[origins].astype(np.float64)
+    delta = star_array[destinations] - start
+    points = start[:, None, :] + delta[:, None, :] * steps[None, :, None]
+    dist, found = nearest_stars(tree, points.reshape(-1, 2))
+    dist = dist.reshape(-1, LINK_STEPS)
+    found = found.reshape(-1, LINK_STEPS)
+
+    too_long = np.cumsum(dist > max_length, axis=1) > 0
+    # Hops after the one that reached the destination are dropped
+    arrived = np.cumsum(found == destinations[:, None], axis=1)
+    arrived = np.concatenate([np.zeros((len(found), 1), dtype=arrived.dtype), arrived[:, :-1]], axis=1) > 0
+    valid = ~too_long & ~arrived
+
+    previous = np.concatenate([origins[:, None], found[:, :-1]], axis=1)
+    drawn = valid & (rolls < conditions[:, None]) & (previous != found)
+    edges = np.stack([previous[drawn], found[drawn]], axis=1)
+    return found[valid], edges
+
+def generate_arm_hyperlanes(settings: Settings, galaxy_config: GalaxyType, center: int, scale: float, size: int, arms: int, arm_index: int, seed: np.random.SeedSequence, stars: Result) -> Result:
+    # Runs as one stage per arm, only the star positions are shared between arms
+    if not (settings.steps.hyperlanes and stars.data):
+        return Result(None, Image.new("RGBA", (1, 1), (0, 0, 0, 0)))
+    # SciPy is the slowest import of the pipeline, only these stages need it
+    from scipy.spatial import KDTree
 
-    current_r = galaxy_config.bar + 0.5 # Start just outside the core
+    start_time = time.time()
+    lanes = settings.generation.hyperlanes
+    fragmentation = settings.generation.fragmentation
+    step_size = lanes.step_size
+    max_length = size / lanes.hyperlane_max_length_factor
+    start_r = galaxy_config.bar + 0.5 # Start just outside the core
+
+    # Star ids index the sorted positions of the index, the same in every process
+    star_index: StarIndex = stars.data[0]
+    star_array = star_index.coords
+    tree = KDTree(star_array)
+    rng = np.random.default_rng(seed)
+
+    # The main lane follows the ideal arm
+    main_drift = rng.uniform(-lanes.main_drift, lanes.main_drift)
+    condition = 1 - rng.uniform(lanes.break_chance_min, lanes.break_chance_max)
+    max_r = int(rng.beta(lanes.main_length_alpha, lanes.main_length_beta) * lanes.main_length_factor)
+    radii = np.arange(start_r, max_r, step_size)
+    samples = get_random_coordinates_on_spiral(rng, galaxy_config, arms, arm_index, radii, scale, center, fragmentation=fragmentation.hyperlanes, drift=main_drift)
+    dist, index = nearest_stars(tree, samples)
+    path = index[dist < max_length]
+    keep = np.ones(len(path), dtype=bool)
+    keep[1:] = path[1:] != path[:-1]
+    path = path[keep].tolist()
+
+    # Links are (origin, destination, condition), branches and clusters get resolved below
+    links: list[tuple[int, int, float]] = []
+    branches, clusters = [], []
     last_special_generation = 0
-
-    fragmentation = settings.generation.fragmentation.hyperlanes
-
-    main_length_factor = settings.generation.hyperlanes.main_length_factor
-    main_length_alpha = settings.generation.hyperlanes.main_length_alpha
-    main_length_beta = settings.generation.hyperlanes.main_length_beta
-    main_drift = settings.generation.hyperlanes.main_drift
-    break_chance_min = settings.generation.hyperlanes.break_chance_max
-    break_chance_min = settings.generation.hyperlanes.break_chance_min
-    special_generation_distance = settings.generation.hyperlanes.special_generation_distance
-
-    main_drift = random.uniform(-main_drift, main_drift)
-    hyperlane_condition = 1 - random.uniform(break_chance_min, break_chance_min)
-    path_stars = []
-
-    max_r = int(random.betavariate(main_length_alpha, main_length_beta) * main_length_factor)
-    while current_r < max_r:
-        ix, iy = get_random_coordinate_on_spiral(galaxy_config, arms, arm_index, current_r, scale, center, fragmentation=fragmentation, drift=main_drift)
-        dist, index = tree.query([ix, iy])
-        current_r += step_size
-
-        if dist < hyperlane_max_length:
-            star_pos = tuple(star_array[index])
-            if not path_stars or star_pos != path_stars[-1]:
-                path_stars.append(star_pos)
-
-    for i in range(len(path_stars) - 1):
-        m_star_1 = path_stars[i]
-        m_star_2 = path_stars[i+1]
-
-        draw_hyperlane(draw, m_star_1, m_star_2, tree, star_array, hyperlane_condition)
-
-        if random.random() < branch_chance and last_special_generation <= special_generation_distance:
-            last_special_generation = special_generation_distance
-            generate_side_hyperlane(
-                draw=draw,
-                settings=settings,
-                galaxy_config=galaxy_config,
-                tree=tree,
-                star_array=star_array,
-                origin=m_star_1,
-                main_drift=main_drift,
-                arms=arms,
-                arm_index=arm_index,
-                scale=scale,
-                center=center,
-                branch_r=galaxy_config.bar + 0.5 + (i * step_size)
-            )
-        elif random.random() < cluster_chance and last_special_generation <= special_generation_distance:
-            last_special_generation = special_generation_distance
-            generate_side_cluster(
-                draw=draw,
-                settings=settings,
-                galaxy_config=galaxy_config,
-                tree=tree,
-                star_array=star_array,
-                origin=m_star_1
-            )
+    for i in range(len(path) - 1):
+        links.append((path[i], path[i+1], condition))
+
+        if rng.random() < lanes.branch_chance and last_special_generation <= lanes.special_generation_distance:
+            last_special_generation = lanes.special_generation_distance
+            branch_length = int(rng.beta(lanes.branch_length_alpha, lanes.branch_length_beta) * lanes.branch_length_factor)
+            branch_drift = rng.normal(lanes.branch_drift_mu, lanes.branch_drift_sigma) + main_drift
+            branch_condition = 1 - rng.uniform(lanes.break_chance_min, lanes.break_chance_max)
+            radii = start_r + (i * step_size) + step_size * np.arange(1, branch_length + 1)
+            points = get_random_coordinates_on_spiral(rng, galaxy_config, arms, arm_index, radii, scale, center, fragmentation=fragmentation.small_hyperlanes, drift=branch_drift)
+            branches.append((path[i], points, branch_condition))
+        elif rng.random() < lanes.cluster_chance and last_special_generation <= lanes.special_generation_distance:
+            last_special_generation = lanes.special_generation_distance
+            cluster_size = int(rng.beta(lanes.cluster_size_alpha, lanes.cluster_size_beta) * lanes.cluster_size_factor)
+            clusters.append((path[i], cluster_size))
         else:
             last_special_generation -= 1
 
-
-def generate_hyperlanes(settings: Settings, galaxy_config: GalaxyType, center: int, scale: float, size: int, arms: int, star_coords: set[tuple[int, int]]) -> Result:
-    if (not settings.steps.stars) or (not settings.steps.stars):
+    # Side branches chain every new star they come close to, all branches are looked up at once
+    if branches:
+        dist, index = nearest_stars(tree, np.concatenate([points for _, points, _ in branches]))
+        offset = 0
+        for origin, points, branch_condition in branches:
+            branch_path = [origin]
+            for b_dist, b_index in zip(dist[offset:offset + len(points)].tolist(), index[offset:offset + len(points)].tolist()):
+                if b_dist < max_length and b_index != branch_path[-1]:
+                    links.append((branch_path[-1], b_index, branch_condition))
+                    branch_path.append(b_index)
+            offset += len(points)
+
+    # Clusters link their origin to a random pick of the stars around it
+    if clusters:
+        telemetry.count("grid_radius_queries", len(clusters))
+        nearby = star_index.within(star_array[[origin for origin, _ in clusters]], max_length)
+        for (origin, cluster_size), nearby_stars in zip(clusters, nearby):
+            nearby_stars = nearby_stars.tolist()
+            rng.shuffle(nearby_stars)
+            links.extend((origin, star, 1) for star in nearby_stars[:cluster_size] if star != origin)
+
+    links_array = np.array([link[:2] for link in links], dtype=np.int64).reshape(-1, 2)
+    link_conditions = np.array([link[2] for link in links], dtype=np.float64)
+    rolls = rng.random((len(links), LINK_STEPS))
+    nodes, edges = walk_links(tree, star_array, links_array[:, 0], links_array[:, 1], link_conditions, rolls, max_length)
+    nodes = np.unique(np.concatenate([nodes, edges.ravel()]))
+    edges = np.searchsorted(nodes, edges)
+    return Result(start_time, Image.new("RGBA", (1, 1), (0, 0, 0, 0)), star_array[nodes], edges)
+
+def generate_hyperlanes(settings: Settings, size: int, *arm_lanes: Result) -> Result:
+    if (not settings.steps.stars) or (not settings.steps.hyperlanes):
         return Result(None, Image.new("RGBA", (1, 1), (0, 0, 0, 0)))
 
-    global step_size, branch_chance, cluster_chance, hyperlane_max_length, hyperlane_max_length_sqr
+    # Arms share stars where they meet, so nodes are merged by position
     start_time = time.time()
-    lane_img = Image.new("RGBA", (size, size), (0, 0, 0, 0))
-    draw = ImageDraw.Draw(lane_img)
-
-    star_array = np.array(list(star_coords))
-    tree = KDTree(star_array)
-
-    step_size = settings.generation.hyperlanes.step_size
-    cluster_chance = settings.generation.hyperlanes.cluster_chance
-    branch_chance = settings.generation.hyperlanes.branch_chance
-    hyperlane_max_length = size / settings.generation.hyperlanes.hyperlane_max_length_factor
-
-    for arm_index in range(arms):
-        generate_main_hyperlane(draw, settings, galaxy_config, tree, star_array, arms, arm_index, scale, center)
-
-    return Result(start_time, lane_img)
+    arm_lanes = tuple(lanes for lanes in arm_lanes if lanes.data)
+    none = np.zeros((0, 2), dtype=np.int64)
+    node_coords = np.concatenate([none, *(lanes.data[0] for lanes in arm_lanes)])
+    offsets = np.cumsum([0] + [len(lanes.data[0]) for lanes in arm_lanes])
+    edges = np.concatenate([none, *(lanes.data[1] + offset for lanes, offset in zip(arm_lanes, offsets))])
+    node_coords, inverse = np.unique(node_coords, axis=0, return_inverse=True)
+    edges = np.unique(np.sort(inverse.reshape(-1)[edges], axis=1), axis=0)
+
+    # Full size and tiled renders rasterize the lanes the same way
+    tile_size = settings.performance.tile_size
+    draw = DrawRecorder(size, tile_size)
+    # Lanes and stops share one color, so the drawing order doesn't matter
+    for node in node_coords.tolist():
+        draw.circle(tuple(node), 2, fill=LANE_COLOR)
+    for a, b in zip(node_coords[edges[:, 0]].tolist(), node_coords[edges[:, 1]].tolist()):
+        draw.line([tuple(a), tuple(b)], fill=LANE_COLOR, width=2)
+
+    def render_tile(box: tuple[int, int, int, int]) -> Image.Image:
+        tile = Image.new("RGBA", (box[2] - box[0], box[3] - box[1]), (0, 0, 0, 0))
+        draw.replay(tile, (box[0], box[1]))
+        return tile
+
+    if tile_size:
+        # Every pixel only depends on its own position, so no halo is needed
+        return Result(start_time, render_tiled(size, "RGBA", tile_size, 0, render_tile), node_coords, edges, particles=len(edges))
+    return Result(start_time, render_tile((0, 0, size, size)), node_coords, edges, particles=len(edges))
@@ -1,18 +1,15 @@
-import random
 import time
-from PIL import Image, ImageDraw, ImageFilter
+import numpy as np
+from PIL import Image
 from src.utils.result_obj import Result
-from src.utils.functions import get_random_coordinate_on_spiral
+from src.utils.layer_store import LayerFile
+from src.utils.particles import Particles, render_particle_layer
+from src.utils.functions import spiral_coordinates
+from src.utils.blur import Blur
 from src.utils.settings import Settings, GalaxyType
+from src.utils import telemetry
 
-def generate_nebula(settings: Settings, galaxy_config: GalaxyType, center: int, scale: float, size: int, arms: int) -> Result:
-    if not settings.steps.nebula:
-        return Result(None, Image.new("RGBA", (1, 1), (0, 0, 0, 0)))
-
-    start_time = time.time()
-    h2_regions = Image.new("RGBA", (size, size), (0, 0, 0, 0))
-    draw = ImageDraw.Draw(h2_regions)
-
+def nebula_particles(rng: np.random.Generator, settings: Settings, galaxy_config: GalaxyType, center: int, scale: float, size: int, arms: int) -> Particles:
     gas_color = (255, 100, 150)
     bright_color = (255, 200, 230)
 
@@ -22,30 +19,41 @@ def generate_nebula(settings: Settings, galaxy_config: GalaxyType, center: int,
     amount_factor = settings.generation.nebula.amount_factor
 
     num_clumps = int(amount_factor * arms * size * size // (2000 * 2000))
-    for _ in range(num_clumps):
-        arm_index = random.randint(0, arms - 1)
-        ring_index = random.sample([1, 1, 1, 1, 2, 2, 3], 1)[0]
-        r = (ring_index * band_spacing) + random.uniform(-band_thickness, band_thickness)
-
-        px, py = get_random_coordinate_on_spiral(galaxy_config, arms, arm_index, r, scale, center, fragmentation=fragmentation)
-
-        for _ in range(random.randint(3, 8)):
-            offset_x = random.gauss(0, size // 200)
-            offset_y = random.gauss(0, size // 200)
-
-            rad = random.randint(size // 300, size // 150)
-            opacity = random.randint(40, 100)
-
-            draw.ellipse(
-                [px + offset_x - rad, py + offset_y - rad,
-                 px + offset_x + rad, py + offset_y + rad],
-                fill=(*bright_color, opacity)
-            )
-            draw.ellipse(
-                [px + offset_x * 0.1 - rad, py + offset_y * 0.1 - rad,
-                 px + offset_x * 0.1 + rad, py + offset_y * 0.1 + rad],
-                fill=(*gas_color, opacity)
-            )
-
-    h2_regions = h2_regions.filter(ImageFilter.GaussianBlur(radius=size // 150))
-    return Result(start_time, h2_regions)
+    arm_index = rng.integers(0, arms, num_clumps)
+    ring_index = rng.choice([1, 1, 1, 1, 2, 2, 3], num_clumps)
+    r = (ring_index * band_spacing) + rng.uniform(-band_thickness, band_thickness, num_clumps)
+
+    px, py = spiral_coordinates(galaxy_config, arms, arm_index, r, scale, center, rng.normal(0, fragmentation / 10, num_clumps))
+
+    # Every clump is a handful of puffs, each a bright and a gas ellipse
+    puffs = rng.integers(3, 9, num_clumps)
+    px = np.repeat(px, puffs)
+    py = np.repeat(py, puffs)
+    puff_count = len(px)
+    offset_x = rng.normal(0, size // 200, puff_count)
+    offset_y = rng.normal(0, size // 200, puff_count)
+    rad = rng.integers(size // 300, size // 150 + 1, puff_count)
+    opacity = rng.integers(40, 101, puff_count)
+
+    x = np.stack([px + offset_x, px + offset_x * 0.1], axis=1).ravel()
+    y = np.stack([py + offset_y, py + offset_y * 0.1], axis=1).ravel()
+    color = np.tile(np.array([bright_color, gas_color]), (puff_count, 1))
+    fill = np.concatenate([color, np.repeat(opacity, 2)[:, None]], axis=1).astype(np.uint8)
+    return Particles(x, y, np.repeat(rad, 2), fill)
+
+def generate_nebula(settings: Settings, galaxy_config: GalaxyType, center: int, scale: float, size: int, arms: int, seed: np.random.SeedSequence, band: tuple[LayerFile, tuple[int, int, int, int]]|None=None) -> Result:
+    if not settings.steps.nebula:
+        return Result(None, Image.new("RGBA", (1, 1), (0, 0, 0, 0)))
+
+    start_time = time.time()
+    rng = np.random.default_rng(seed)
+    particles = nebula_particles(rng, settings, galaxy_config, center, scale, size, arms)
+    telemetry.count("particles_drawn", len(particles))
+    telemetry.count("particles_accepted", len(particles))
+
+    blur_radius = size // 150
+    h2_regions = render_particle_layer(
+        size, "RGBA", particles, settings.performance.particle_backend, Blur("gaussian", blur_radius, settings.performance.blur_engine),
+        settings.performance.tile_size, band
+    )
+    return Result(start_time, h2_regions, particles=len(particles))
@@ -1,46 +1,55 @@
-import math
-import random
 import time
-from PIL import Image, ImageDraw, ImageFilter
+import numpy as np
+from PIL import Image
 from src.utils.result_obj import Result
-from src.utils.functions import get_random_coordinate_on_spiral, lerp_color
+from src.utils.layer_store import LayerFile
+from src.utils.particles import Particles, render_particle_layer
+from src.utils.functions import spiral_coordinates
+from src.utils.blur import Blur
 from src.utils.settings import Settings, GalaxyType
+from src.utils import telemetry
 
-def generate_spiral_arms(settings: Settings, galaxy_config: GalaxyType, center: int, scale: float, size: int, arms: int, colors, weakness) -> Result:
-    if not settings.steps.spirals:
-        return Result(None, Image.new("RGBA", (1, 1), (0, 0, 0, 0)))
-
-    start_time = time.time()
-    nebula = Image.new("RGBA", (size, size), (0, 0, 0, 0))
-    neb_draw = ImageDraw.Draw(nebula)
-
-    core_color = colors[0]
-    mid_color = colors[1]
-    outer_color = colors[2]
+def spiral_arm_particles(rng: np.random.Generator, settings: Settings, galaxy_config: GalaxyType, center: int, scale: float, size: int, arms: int, colors, weakness) -> Particles:
+    core_color = np.array(colors[0][:3])
+    mid_color = np.array(colors[1][:3])
+    outer_color = np.array(colors[2][:3])
     fragmentation = settings.generation.fragmentation.spirals
     amount_factor = settings.generation.spirals.amount_factor
 
     nebula_count = int(amount_factor * size * size // (2000 * 2000))
-    for _ in range(nebula_count):
-        arm_index = random.randint(0, arms - 1)
-        r = random.uniform(0.1, 15.0)
+    arm_index = rng.integers(0, arms, nebula_count)
+    r = rng.uniform(0.1, 15.0, nebula_count)
 
-        norm_r = min(r / 15.0, 1.0)
+    norm_r = np.minimum(r / 15.0, 1.0)[:, None]
+    current_color = np.where(
+        norm_r < 0.4,
+        core_color + (mid_color - core_color) * (norm_r / 0.4),
+        mid_color + (outer_color - mid_color) * ((norm_r - 0.4) / 0.7),
+    ).astype(np.int64)
 
-        if norm_r < 0.4:
-            current_color = lerp_color(core_color, mid_color, norm_r / 0.4)
-        else:
-            current_color = lerp_color(mid_color, outer_color, (norm_r - 0.4) / 0.7)
+    # Fade opacity exponentially as it gets further out
+    opacity = (255 * np.exp(-0.2 * r) * weakness).astype(np.int64)
 
-        # Fade opacity exponentially as it gets further out
-        opacity = int(255 * math.exp(-0.2 * r) * weakness)
-        fill_tuple = current_color + (opacity,)
+    px, py = spiral_coordinates(galaxy_config, arms, arm_index, r, scale, center, rng.normal(0, fragmentation / 10, nebula_count))
 
-        px, py = get_random_coordinate_on_spiral(galaxy_config, arms, arm_index, r, scale, center, fragmentation=fragmentation)
+    inside = (0 <= px) & (px < size) & (0 <= py) & (py < size)
+    rad = ((size - size * r * 0.06) // 60).astype(np.int64)
+    fill = np.concatenate([current_color, opacity[:, None]], axis=1).astype(np.uint8)
+    telemetry.count("particles_drawn", len(px))
+    return Particles(px, py, rad, fill).subset(inside)
 
-        if 0 <= px < size and 0 <= py < size:
-            rad = int((size - size * r * 0.06) // 60)
-            neb_draw.ellipse([px-rad, py-rad, px+rad, py+rad], fill=fill_tuple)
+def generate_spiral_arms(settings: Settings, galaxy_config: GalaxyType, center: int, scale: float, size: int, arms: int, colors, weakness, seed: np.random.SeedSequence, band: tuple[LayerFile, tuple[int, int, int, int]]|None=None) -> Result:
+    if not settings.steps.spirals:
+        return Result(None, Image.new("RGBA", (1, 1), (0, 0, 0, 0)))
 
-    nebula = nebula.filter(ImageFilter.GaussianBlur(radius=size//70))
-    return Result(start_time, nebula)
\ No newline at end of file
+    start_time = time.time()
+    rng = np.random.default_rng(seed)
+    particles = spiral_arm_particles(rng, settings, galaxy_config, center, scale, size, arms, colors, weakness)
+    telemetry.count("particles_accepted", len(particles))
+
+    blur_radius = size//70
+    nebula = render_particle_layer(
+        size, "RGBA", particles, settings.performance.particle_backend, Blur("gaussian", blur_radius, settings.performance.blur_engine),
+        settings.performance.tile_size, band
+    )
+    return Result(start_time, nebula, particles=len(particles))
@@ -1,99 +1,327 @@
 import math
-import random
 import time
+import numpy as np
 from PIL import Image, ImageDraw
-from src.utils.functions import get_random_coordinate_on_spiral, lerp_color
+from src.utils.functions import get_random_coordinate_on_spiral, lerp_color, spiral_coordinates
 from src.utils.result_obj import Result
 from src.utils.settings import Settings, GalaxyType
+from src.utils.tiles import render_tiled
+from src.utils.spatial_index import OccupancyBitmap, StarIndex
+from src.utils.star_catalog import STAR_DTYPE, star_catalog
+from src.utils import telemetry
 
-def has_collision(x, y, occupied_pixels, radius=3) -> bool:
-    for dx in range(-radius, radius + 1):
-        for dy in range(-radius, radius + 1):
-            if (x + dx, y + dy) in occupied_pixels:
-                return True
-    return False
+STAR_BATCH_SIZE = 4096
 
-def draw_star(draw, px, py, color, shape) -> None:
-    brightness = random.uniform(0.8, 1.5)
-    base_color = tuple(min(255, int(c * brightness)) for c in color)
+# Spectral classes of main sequence stars and their colors
+STAR_CLASSES = [
+    ("O5(V)", (157, 180, 255)),
+    ("B1(V)", (162, 185, 255)),
+    ("B3(V)", (167, 188, 255)),
+    ("B5(V)", (170, 191, 255)),
+    ("B8(V)", (175, 195, 255)),
+    ("A1(V)", (186, 204, 255)),
+    ("A3(V)", (192, 209, 255)),
+    ("A5(V)", (202, 216, 255)),
+    ("F0(V)", (228, 232, 255)),
+    ("F2(V)", (237, 238, 255)),
+    ("F5(V)", (251, 248, 255)),
+    ("F8(V)", (255, 249, 249)),
+    ("G2(V)", (255, 245, 236)),
+    ("G5(V)", (255, 244, 232)),
+    ("G8(V)", (255, 241, 223)),
+    ("K0(V)", (255, 235, 209)),
+    ("K4(V)", (255, 215, 174)),
+    ("K7(V)", (255, 198, 144)),
+    ("M2(V)", (255, 190, 127)),
+    ("M4(V)", (255, 187, 123)),
+    ("M6(V)", (255, 187, 123)),
+]
+# Shapes and how far they reach beyond the center pixel
+STAR_SHAPES = [
+    ("dot", 0),
+    ("cross", 2),
+    ("big_cross", 2),
+    ("x", 2),
+    ("big_x", 3),
+]
+
+LINE_ROLE = 10
+CORE_ROLE = 11
 
-    glow_radius = random.randint(2, 3)
+def star_strokes(px, py, shape, glow_radius) -> list[tuple[str, list, int]]:
+    # Glow rings use their radius as role, outer rings are drawn first
+    strokes = []
     for r in range(glow_radius, 0, -1):
-        alpha = int(20 * (1.0 - (r / (glow_radius + 1))))
-        glow_color = base_color + (alpha,)
-        draw.ellipse([px-r, py-r, px+r, py+r], fill=glow_color)
+        strokes.append(("ellipse", [px-r, py-r, px+r, py+r], r))
 
-    glow_faint = base_color + (60,)
     match shape:
         case "cross" | "big_cross":
             length = 1 if shape == "cross" else 2
-            draw.line([(px-length, py), (px+length, py)], fill=glow_faint, width=1)
-            draw.line([(px, py-length), (px, py+length)], fill=glow_faint, width=1)
+            strokes.append(("line", [(px-length, py), (px+length, py)], LINE_ROLE))
+            strokes.append(("line", [(px, py-length), (px, py+length)], LINE_ROLE))
         case "x" | "big_x":
             length = 1 if shape == "x" else 2
-            draw.line([(px-length, py-length), (px+length, py+length)], fill=glow_faint, width=1)
-            draw.line([(px+length, py-length), (px-length, py+length)], fill=glow_faint, width=1)
+            strokes.append(("line", [(px-length, py-length), (px+length, py+length)], LINE_ROLE))
+            strokes.append(("line", [(px+length, py-length), (px-length, py+length)], LINE_ROLE))
+
+    strokes.append(("point", [(px, py)], CORE_ROLE))
+    return strokes
+
+def draw_star(draw, px, py, color, shape, brightness, glow_radius) -> None:
+    base_color = tuple(min(255, int(c * brightness)) for c in color)
+
+    for kind, xy, role in star_strokes(px, py, shape, glow_radius):
+        if role == CORE_ROLE:
+            fill = lerp_color(base_color, (255, 255, 255), 0.7)
+        elif role == LINE_ROLE:
+            fill = base_color + (60,)
+        else:
+            fill = base_color + (int(20 * (1.0 - (role / (glow_radius + 1)))),)
+        getattr(draw, kind)(xy, fill=fill)
+
+def build_star_sprite(shape: str, glow_radius: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Rasterize the strokes once with their role as "color" to get the exact footprint
+    extent = glow_radius + 3
+    canvas = Image.new("L", (2 * extent + 1, 2 * extent + 1), 0)
+    draw = ImageDraw.Draw(canvas)
+    for kind, xy, role in star_strokes(extent, extent, shape, glow_radius):
+        getattr(draw, kind)(xy, fill=role)
+
+    roles = np.asarray(canvas)
+    dy, dx = np.nonzero(roles)
+    return dx - extent, dy - extent, roles[dy, dx]
+
+def stamp_stars(box: tuple[int, int, int, int], xs: np.ndarray, ys: np.ndarray, colors: np.ndarray, shapes: list[str], shape_index: np.ndarray, brightness: np.ndarray, glow_radius: np.ndarray) -> Image.Image:
+    left, top, right, bottom = box
+    width, height = right - left, bottom - top
+
+    # Sprites never reach further than a few pixels from their star
+    near = (xs >= left - 8) & (xs < right + 8) & (ys >= top - 8) & (ys < bottom + 8)
+    xs, ys, colors = xs[near] - left, ys[near] - top, colors[near]
+    shape_index, brightness, glow_radius = shape_index[near], brightness[near], glow_radius[near]
+
+    base_color = np.minimum(255, (colors * brightness[:, None]).astype(np.int64))
+    core_color = (base_color + (255 - base_color) * 0.7).astype(np.int64)
+
+    positions, values, order = [], [], []
+    for shape_id, shape in enumerate(shapes):
+        for glow in np.unique(glow_radius).tolist():
+            members = np.flatnonzero((shape_index == shape_id) & (glow_radius == glow))
+            if len(members) == 0:
+                continue
+            dx, dy, roles = build_star_sprite(shape, glow)
+
+            px = xs[members][:, None] + dx[None, :]
+            py = ys[members][:, None] + dy[None, :]
+            alpha = np.where(roles == LINE_ROLE, 60, (20 * (1.0 - (roles / (glow + 1)))).astype(np.int64))
+            is_core = (roles == CORE_ROLE)[None, :, None]
+            rgb = np.where(is_core, core_color[members][:, None, :], base_color[members][:, None, :])
+            a = np.where(roles == CORE_ROLE, 255, alpha)[None, :, None].repeat(len(members), axis=0)
+
+            inside = (0 <= px) & (px < width) & (0 <= py) & (py < height)
+            positions.append((py * width + px)[inside])
+            values.append(np.concatenate([rgb, a], axis=2)[inside])
+            order.append(np.broadcast_to(members[:, None], px.shape)[inside])
+
+    buffer = np.zeros((width * height, 4), dtype=np.uint8)
+    positions = np.concatenate(positions) if positions else np.zeros(0, dtype=np.int64)
+    if len(positions):
+        values = np.concatenate(values)
+        order = np.concatenate(order)
+
+        # Later stars overwrite earlier ones, just like consecutive draw calls
+        last = np.lexsort((order, positions))
+        positions, values = positions[last], values[last]
+        keep = np.append(positions[1:] != positions[:-1], True)
+        buffer[positions[keep]] = values[keep]
+
+    return Image.frombuffer("RGBA", (width, height), buffer, "raw", "RGBA", 0, 1).copy()
+
+def draw_star_candidates(rng: np.random.Generator, galaxy_config: GalaxyType, center: int, scale: float, arms: int, num_stars: int, fragmentation: float, color_count: int, shape_count: int) -> dict[str, np.ndarray]:
+    spiral_chance = 1 - galaxy_config.core_chance
+    on_spiral = rng.random(num_stars) < spiral_chance
+
+    # Spiral arm stars
+    arm_index = rng.integers(0, arms, num_stars)
+    r = rng.exponential(1 / 0.6, num_stars) + galaxy_config.bar + 0.2
+    jitter = rng.normal(0, fragmentation / 10, num_stars)
+
+    # Core stars
+    core_spread = galaxy_config.core_spread * (1 + galaxy_config.bar * 0.5)
+    r_x = rng.uniform(0, core_spread, num_stars)
+    r_y = rng.uniform(0, core_spread, num_stars)
+    angle_core = rng.uniform(0, 2 * np.pi, num_stars)
+    # Every star draws both positions so the streams stay aligned, only the one it uses gets evaluated
+    in_core = ~on_spiral
+    lx = r_x[in_core] * np.cos(angle_core[in_core])
+    ly = r_y[in_core] * np.sin(angle_core[in_core])
+    rotation = 80
+    px = np.empty(num_stars, dtype=np.int64)
+    py = np.empty(num_stars, dtype=np.int64)
+    # astype() truncates towards zero just like int()
+    px[in_core] = (center + (lx * math.cos(rotation) - ly * math.sin(rotation)) * scale).astype(np.int64)
+    py[in_core] = (center + (lx * math.sin(rotation) + ly * math.cos(rotation)) * scale).astype(np.int64)
+    px[on_spiral], py[on_spiral] = spiral_coordinates(galaxy_config, arms, arm_index[on_spiral], r[on_spiral], scale, center, jitter[on_spiral])
+
+    dist_from_center = np.sqrt(px.astype(np.float64)**2 + py**2)
+    buffer_roll = rng.random(num_stars)
+    collision_buffer = np.select(
+        [dist_from_center < 0.6, dist_from_center < 1, dist_from_center < 1.25, dist_from_center < 1.5, dist_from_center < 1.75],
+        [1, 2, np.where(buffer_roll > 0.3, 4, 3), np.where(buffer_roll > 0.5, 4, 5), np.where(buffer_roll > 0.7, 5, 4)],
+        default=4,
+    )
+
+    return {
+        "x": px,
+        "y": py,
+        "arm": np.where(on_spiral, arm_index, -1),
+        "buffer": collision_buffer,
+        "color": rng.integers(0, color_count, num_stars),
+        "shape": rng.integers(0, shape_count, num_stars),
+        "brightness": rng.uniform(0.8, 1.5, num_stars),
+        "glow_radius": rng.integers(2, 4, num_stars),
+    }
 
-    core_color = lerp_color(base_color, (255, 255, 255), 0.7)
-    draw.point((px, py), fill=core_color)
+def resolve_batch_collisions(xs: np.ndarray, ys: np.ndarray, radii: np.ndarray, max_radius: int) -> np.ndarray:
+    # Candidates in one batch are accepted in order; only those with an earlier
+    # neighbour inside their radius need to be walked one by one
+    count = len(xs)
+    accepted = np.ones(count, dtype=bool)
+    if count < 2:
+        return accepted
 
-def generate_stars(settings: Settings, galaxy_config: GalaxyType, center: int, scale: float, size: int, arms: int, num_stars: int) -> Result:
+    cell = max_radius + 1
+    columns = int(xs.max()) // cell + 3
+    keys = (ys // cell) * columns + (xs // cell)
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+
+    pair_i, pair_j = [], []
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            target = keys + dy * columns + dx
+            lo = np.searchsorted(sorted_keys, target, "left")
+            hi = np.searchsorted(sorted_keys, target, "right")
+            counts = hi - lo
+            total = int(counts.sum())
+            if total == 0:
+                continue
+            starts = np.repeat(lo - (np.cumsum(counts) - counts), counts)
+            pair_i.append(np.repeat(np.arange(count), counts))
+            pair_j.append(order[starts + np.arange(total)])
+
+    if not pair_i:
+        return accepted
+    i = np.concatenate(pair_i)
+    j = np.concatenate(pair_j)
+    reach = np.maximum(np.abs(xs[i] - xs[j]), np.abs(ys[i] - ys[j]))
+    conflict = (j < i) & (reach <= radii[i])
+    i, j = i[conflict], j[conflict]
+    if len(i) == 0:
+        return accepted
+
+    order = np.argsort(i, kind="stable")
+    i, j = i[order], j[order]
+    conflicted, starts = np.unique(i, return_index=True)
+    ends = np.append(starts[1:], len(i))
+    for candidate, start, end in zip(conflicted.tolist(), starts.tolist(), ends.tolist()):
+        accepted[candidate] = not accepted[j[start:end]].any()
+    return accepted
+
+def resolve_collisions(xs: np.ndarray, ys: np.ndarray, radii: np.ndarray, size: int) -> np.ndarray:
+    accepted = np.zeros(len(xs), dtype=bool)
+    if len(xs) == 0:
+        return accepted
+
+    max_radius = int(radii.max())
+    occupied = OccupancyBitmap(size)
+    for start in range(0, len(xs), STAR_BATCH_SIZE):
+        bx = xs[start:start + STAR_BATCH_SIZE]
+        by = ys[start:start + STAR_BATCH_SIZE]
+        br = radii[start:start + STAR_BATCH_SIZE]
+
+        # Reject against every star accepted in earlier batches
+        free = np.flatnonzero(~occupied.any_within(bx, by, br))
+
+        # Then against earlier candidates of this batch
+        free = free[resolve_batch_collisions(bx[free], by[free], br[free], max_radius)]
+        occupied.add(bx[free], by[free])
+        accepted[start + free] = True
+    return accepted
+
+def generate_stars(settings: Settings, galaxy_config: GalaxyType, center: int, scale: float, size: int, arms: int, num_stars: int, seed: np.random.SeedSequence) -> Result:
     if not settings.steps.stars:
         return Result(None, Image.new("RGBA", (1, 1), (0, 0, 0, 0)))
 
     start_time = time.time()
-    stars = Image.new("RGBA", (size, size), (0, 0, 0, 0))
-    star_draw = ImageDraw.Draw(stars, "RGBA")
-
     border_inner = size // 20
     border_outer = size - size // 20
 
-    star_coords = set()
-    occupied_pixels = set()
-    star_colors = [
-        (157, 180, 255), # O5(V)
-        (162, 185, 255), # B1(V)
-        (167, 188, 255), # B3(V)
-        (170, 191, 255), # B5(V)
-        (175, 195, 255), # B8(V)
-        (186, 204, 255), # Al(V)
-        (192, 209, 255), # A3(V)
-        (202, 216, 255), # A5(V)
-        (228, 232, 255), # FO(V)
-        (237, 238, 255), # F2(V)
-        (251, 248, 255), # F5(V)
-        (255, 249, 249), # F8(V)
-        (255, 245, 236), # G2(V)
-        (255, 244, 232), # G5(V)
-        (255, 241, 223), # G8(V)
-        (255, 235, 209), # KO(V)
-        (255, 215, 174), # K4(V)
-        (255, 198, 144), # K7(V)
-        (255, 190, 127), # M2(V)
-        (255, 187, 123), # M4(V)
-        (255, 187, 123), # M6(V)
-    ]
-    star_shapes = [
-        ("dot", 0),
-        ("cross", 2),
-        ("big_cross", 2),
-        ("x", 2),
-        ("big_x", 3),
-    ]
-
+    star_colors = [color for _, color in STAR_CLASSES]
+    star_shapes = STAR_SHAPES
     fragmentation = settings.generation.fragmentation.stars
 
+    # Tiled renders need every star up front, so they always place stars in batches
+    tile_size = settings.performance.tile_size
+    rng = np.random.default_rng(seed)
+    if settings.performance.vectorized_stars or tile_size:
+        candidates = draw_star_candidates(rng, galaxy_config, center, scale, arms, num_stars, fragmentation, len(star_colors), len(star_shapes))
+
+        inside = ((border_inner <= candidates["x"]) & (candidates["x"] < border_outer) &
+                  (border_inner <= candidates["y"]) & (candidates["y"] < border_outer))
+        candidates = {key: value[inside] for key, value in candidates.items()}
+        telemetry.count("stars_attempted", num_stars)
+        telemetry.count("stars_out_of_bounds", num_stars - len(candidates["x"]))
+
+        shape_radii = np.array([shape_radius for _, shape_radius in star_shapes])
+        radii = candidates["buffer"] + shape_radii[candidates["shape"]]
+        accepted = resolve_collisions(candidates["x"], candidates["y"], radii, size)
+        telemetry.count("stars_rejected", len(accepted) - int(accepted.sum()))
+        candidates = {key: value[accepted] for key, value in candidates.items()}
+        telemetry.count("stars_placed", len(candidates["x"]))
+
+        catalog = star_catalog(candidates["x"], candidates["y"], candidates["color"], candidates["shape"], candidates["brightness"], candidates["arm"])
+        colors = np.array(star_colors)[candidates["color"]]
+        shapes = [shape for shape, _ in star_shapes]
+
+        def render_box(box: tuple[int, int, int, int]) -> Image.Image:
+            if settings.performance.sprite_stars:
+                return stamp_stars(box, candidates["x"], candidates["y"], colors, shapes, candidates["shape"], candidates["brightness"], candidates["glow_radius"])
+
+            tile = Image.new("RGBA", (box[2] - box[0], box[3] - box[1]), (0, 0, 0, 0))
+            tile_draw = ImageDraw.Draw(tile, "RGBA")
+            near = ((candidates["x"] >= box[0] - 8) & (candidates["x"] < box[2] + 8) &
+                    (candidates["y"] >= box[1] - 8) & (candidates["y"] < box[3] + 8))
+            for px, py, color, shape, brightness, glow_radius in zip(
+                candidates["x"][near].tolist(), candidates["y"][near].tolist(), candidates["color"][near].tolist(),
+                candidates["shape"][near].tolist(), candidates["brightness"][near].tolist(), candidates["glow_radius"][near].tolist()
+            ):
+                draw_star(tile_draw, px - box[0], py - box[1], star_colors[color], star_shapes[shape][0], brightness=brightness, glow_radius=glow_radius)
+            return tile
+
+        if tile_size:
+            stars = render_tiled(size, "RGBA", tile_size, 0, render_box)
+        else:
+            stars = render_box((0, 0, size, size))
+        return Result(start_time, stars, StarIndex(catalog, size), particles=num_stars)
+
+    stars = Image.new("RGBA", (size, size), (0, 0, 0, 0))
+    star_draw = ImageDraw.Draw(stars, "RGBA")
+    occupied = OccupancyBitmap(size)
+    placed = []
+    out_of_bounds = rejected = 0
     for _ in range(num_stars):
         spiral_chance = 1 - galaxy_config.core_chance
 
-        if random.random() < spiral_chance:
-            arm_index = random.randint(0, arms - 1)
-            r = random.expovariate(0.6) + galaxy_config.bar + 0.2
-            px, py = get_random_coordinate_on_spiral(galaxy_config, arms, arm_index, r, scale, center, fragmentation=fragmentation)
+        arm_index = -1
+        if rng.random() < spiral_chance:
+            arm_index = int(rng.integers(0, arms))
+            r = rng.exponential(1 / 0.6) + galaxy_config.bar + 0.2
+            px, py = get_random_coordinate_on_spiral(rng, galaxy_config, arms, arm_index, r, scale, center, fragmentation=fragmentation)
         else:
-            r_x = random.uniform(0, galaxy_config.core_spread * (1 + galaxy_config.bar * 0.5))
-            r_y = random.uniform(0, galaxy_config.core_spread * (1 + galaxy_config.bar * 0.5))
-            angle_core = random.uniform(0, 2 * math.pi)
+            r_x = rng.uniform(0, galaxy_config.core_spread * (1 + galaxy_config.bar * 0.5))
+            r_y = rng.uniform(0, galaxy_config.core_spread * (1 + galaxy_config.bar * 0.5))
+            angle_core = rng.uniform(0, 2 * math.pi)
 
             lx = r_x * math.cos(angle_core)
             ly = r_y * math.sin(angle_core)
@@ -103,24 +331,32 @@ def generate_stars(settings: Settings, galaxy_config: GalaxyType, center: int, s
             py = int(center + (lx * math.sin(rotation) + ly * math.cos(rotation)) * scale)
 
         if not (border_inner <= px < border_outer and border_inner <= py < border_outer):
+            out_of_bounds += 1
             continue
 
         dist_from_center = math.sqrt(px**2 + py**2)
         if dist_from_center < 0.6:      collision_buffer = 1
         elif dist_from_center < 1:      collision_buffer = 2
-        elif dist_from_center < 1.25:   collision_buffer = 4 if random.random() > 0.3 else 3
-        elif dist_from_center < 1.5:    collision_buffer = 4 if random.random() > 0.5 else 5
-        elif dist_from_center < 1.75:   collision_buffer = 5 if random.random() > 0.7 else 4
+        elif dist_from_center < 1.25:   collision_buffer = 4 if rng.random() > 0.3 else 3
+        elif dist_from_center < 1.5:    collision_buffer = 4 if rng.random() > 0.5 else 5
+        elif dist_from_center < 1.75:   collision_buffer = 5 if rng.random() > 0.7 else 4
         else:                           collision_buffer = 4
 
-        star_color = random.choice(star_colors)
-        shape, shape_radius = random.choice(star_shapes)
+        color = int(rng.integers(0, len(star_colors)))
+        shape_index = int(rng.integers(0, len(star_shapes)))
+        shape, shape_radius = star_shapes[shape_index]
 
-        if has_collision(px, py, occupied_pixels, radius=collision_buffer + shape_radius):
+        if occupied.any_near(px, py, collision_buffer + shape_radius):
+            rejected += 1
             continue
 
-        draw_star(star_draw, px, py, star_color, shape)
-        occupied_pixels.add((px, py))
-        star_coords.add((px, py))
+        brightness = rng.uniform(0.8, 1.5)
+        draw_star(star_draw, px, py, star_colors[color], shape, brightness=brightness, glow_radius=int(rng.integers(2, 4)))
+        occupied.add(px, py)
+        placed.append((px, py, color, shape_index, brightness, arm_index))
 
-    return Result(start_time, stars, star_coords)
\ No newline at end of file
+    telemetry.count("stars_attempted", num_stars)
+    telemetry.count("stars_out_of_bounds", out_of_bounds)
+    telemetry.count("stars_rejected", rejected)
+    telemetry.count("stars_placed", len(placed))
+    return Result(start_time, stars, StarIndex(np.array(placed, dtype=STAR_DTYPE), size), particles=num_stars)
\ No newline at end of file
@@ -0,0 +1,122 @@
+import functools
+import hashlib
+import os
+import pickle
+import shutil
+import sys
+import uuid
+import numpy as np
+from src.utils import layer_store
+from src.utils.layer_store import LayerFile
+from src.utils.result_obj import Result
+
+@functools.cache
+def code_version() -> str:
+    # Any change to the generator sources invalidates every entry
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    paths = [os.path.join(root, "main.py")]
+    for directory, _, files in os.walk(os.path.join(root, "src")):
+        paths.extend(os.path.join(directory, file) for file in files if file.endswith(".py"))
+
+    digest = hashlib.sha256()
+    for path in sorted(paths):
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                digest.update(f.read())
+    if getattr(sys, "frozen", False):
+        # Bundled builds ship without sources, the executable stands in for them
+        digest.update(f"{sys.executable}:{os.path.getmtime(sys.executable)}".encode())
+    return digest.hexdigest()
+
+def link_or_copy(source: str, destination: str) -> None:
+    # Layer files are never written after their stage finished, so sharing the inode is safe
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+class LayerCache:
+    """Stage results on disk, addressed by a hash of everything they depend on.
+
+    Every entry is a directory with the layer as .npy and the rest of the
+    Result pickled next to it. Least recently used entries are evicted once
+    the cache grows past its limit.
+    """
+    def __init__(self, directory: str, limit_mb: int, tiled: bool):
+        self.directory = directory
+        self.limit = limit_mb * 1024 * 1024
+        self.tiled = tiled
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, name: str, inputs: tuple, dep_keys: tuple[str, ...]=()) -> str:
+        return hashlib.sha256(repr((name, inputs, dep_keys, code_version())).encode()).hexdigest()
+
+    def load(self, key: str) -> Result|None:
+        if layer_store.layers_dir is None:
+            raise RuntimeError("No layer directory configured for this process")
+        entry = os.path.join(self.directory, key)
+        try:
+            with open(os.path.join(entry, "result.pickle"), "rb") as f:
+                meta = pickle.load(f)
+            path = os.path.join(layer_store.layers_dir, f"{uuid.uuid4().hex}.npy") # type: ignore
+            link_or_copy(os.path.join(entry, "layer.npy"), path)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        os.utime(entry)
+
+        layer = LayerFile(path, meta["size"], meta["mode"])
+        result = Result(None, layer if self.tiled and layer.size > 1 else layer.to_image(), *meta["data"], particles=meta["particles"])
+        if not isinstance(result.image, LayerFile):
+            result._shared = layer
+        result.time = 0.0
+        result.cached = True
+        return result
+
+    def store(self, key: str, result: Result) -> None:
+        entry = os.path.join(self.directory, key)
+        if os.path.exists(entry):
+            return
+
+        # Entries are assembled under a temporary name, so concurrent runs never see half of one
+        staging = os.path.join(self.directory, f"tmp_{uuid.uuid4().hex}")
+        os.makedirs(staging)
+        try:
+            image = result.image
+            if isinstance(image, LayerFile):
+                image.flush()
+                link_or_copy(image.path, os.path.join(staging, "layer.npy"))
+                size, mode = image.size, image.mode
+            elif result._shared is not None and image.readonly:
+                link_or_copy(result._shared.path, os.path.join(staging, "layer.npy"))
+                size, mode = result._shared.size, result._shared.mode
+            else:
+                np.save(os.path.join(staging, "layer.npy"), np.asarray(image))
+                size, mode = image.width, image.mode
+
+            with open(os.path.join(staging, "result.pickle"), "wb") as f:
+                pickle.dump({"size": size, "mode": mode, "data": result.data, "particles": result.particles}, f)
+            os.rename(staging, entry)
+        except OSError:
+            shutil.rmtree(staging, ignore_errors=True)
+            return
+        self.evict()
+
+    def evict(self) -> None:
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if name.startswith("tmp_"):
+                continue
+            entry = os.path.join(self.directory, name)
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, file)) for file in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+            except OSError:
+                continue
+            total += size
+
+        for _, size, entry in sorted(entries):
+            if total <= self.limit:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
@@ -1,15 +1,39 @@
-import math
-import random
+import functools
+import numpy as np
 from src.utils.settings import GalaxyType
 
 def lerp_color(c1: tuple, c2: tuple, t) -> tuple[int, ...]:
     return tuple(int(c1[i] + (c2[i] - c1[i]) * t) for i in range(3))
 
-def get_random_coordinate_on_spiral(galaxy_config: GalaxyType, arm_count: int, arm_index, radius: float, scale: float, center: int, fragmentation: float=0.0, drift: float=0.0) -> tuple[int, int]:
-    theta = (1.0 / galaxy_config.tightness) * math.log(radius + 0.1)
-    theta += random.gauss(0, fragmentation/10) + drift/360
-    theta += (arm_index * 2 * math.pi / arm_count)
+@functools.cache
+def arm_angles(arm_count: int) -> np.ndarray:
+    # Where every arm starts, looked up per point instead of recomputed
+    angles = np.arange(arm_count) * 2 * np.pi / arm_count
+    angles.setflags(write=False)
+    return angles
 
-    px = int(center + (radius * math.cos(theta) * scale))
-    py = int(center + (radius * math.sin(theta) * scale))
+def spiral_coordinates(galaxy_config: GalaxyType, arm_count: int, arm_index: np.ndarray|int, radius: np.ndarray, scale: float, center: int, jitter: np.ndarray|float=0.0) -> tuple[np.ndarray, np.ndarray]:
+    """Pixel coordinates of points on the logarithmic spiral arms.
+
+    Arm indices, radii and jitter (an angle offset in radians, usually noise
+    drawn by the caller) broadcast against each other. This is the one place
+    the spiral is evaluated, every generator places its points through it.
+    """
+    theta = (1.0 / galaxy_config.tightness) * np.log(radius + 0.1)
+    theta = theta + jitter
+    theta += arm_angles(arm_count)[arm_index]
+
+    px = (center + radius * np.cos(theta) * scale).astype(np.int64)
+    py = (center + radius * np.sin(theta) * scale).astype(np.int64)
     return px, py
+
+def get_random_coordinate_on_spiral(rng: np.random.Generator, galaxy_config: GalaxyType, arm_count: int, arm_index, radius: float, scale: float, center: int, fragmentation: float=0.0, drift: float=0.0) -> tuple[int, int]:
+    # Scalar version for the per-star loops, draws one normal like before
+    jitter = rng.normal(0, fragmentation/10) + drift/360
+    px, py = spiral_coordinates(galaxy_config, arm_count, arm_index, radius, scale, center, jitter)
+    return int(px), int(py)
+
+def get_random_coordinates_on_spiral(rng: np.random.Generator, galaxy_config: GalaxyType, arm_count: int, arm_index, radius: np.ndarray, scale: float, center: int, fragmentation: float=0.0, drift: float=0.0) -> np.ndarray:
+    # One (x, y) row per radius
+    jitter = rng.normal(0, fragmentation/10, len(radius)) + drift/360
+    return np.stack(spiral_coordinates(galaxy_config, arm_count, arm_index, radius, scale, center, jitter), axis=1)
@@ -0,0 +1,56 @@
+import os
+import sys
+from typing import BinaryIO, Callable, Iterable
+import numpy as np
+from PIL import Image
+from src.utils.settings import Export
+from src.utils.png_stream import write_png
+from src.utils.tiles import band_boxes
+
+EXTENSIONS = {"png": ".png", "png_fast": ".png", "npy": ".npy", "webp": ".webp", "tiff": ".tiff"}
+TIFF_COMPRESSION = {"none": "raw", "deflate": "tiff_adobe_deflate", "lzw": "tiff_lzw"}
+
+def image_extension(format: str) -> str:
+    if format not in EXTENSIONS:
+        raise ValueError(f"Unknown export format '{format}'")
+    return EXTENSIONS[format]
+
+def check_image_format(export: Export) -> None:
+    image_extension(export.format)
+    if export.format == "tiff" and export.tiff_compression not in TIFF_COMPRESSION:
+        raise ValueError(f"Unknown TIFF compression '{export.tiff_compression}'")
+
+def is_headless() -> bool:
+    # Without a display server there is no viewer to open
+    if sys.platform in ("win32", "darwin"):
+        return False
+    return not (os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY"))
+
+def write_npy(fp: BinaryIO, width: int, height: int, mode: str, bands: Iterable[np.ndarray]) -> None:
+    # Plain uint8 rows behind a .npy header, np.load(mmap_mode="r") maps them without decoding
+    shape = (height, width) if len(mode) == 1 else (height, width, len(mode))
+    np.lib.format.write_array_header_2_0(fp, {"descr": "|u1", "fortran_order": False, "shape": shape})
+    for band in bands:
+        fp.write(np.ascontiguousarray(band, dtype=np.uint8).tobytes())
+
+def write_image(fp: BinaryIO, size: int, mode: str, read_box: Callable[[tuple[int, int, int, int]], Image.Image], band_rows: int, export: Export, threads: int=1) -> None:
+    """Encodes a size x size image in the export format, reading it band by band where the format allows."""
+    bands = (np.asarray(read_box(box)) for box in band_boxes(size, band_rows))
+    match export.format:
+        case "png":
+            write_png(fp, size, size, mode, bands, export.png_compress_level, export.png_optimize, threads)
+        case "png_fast":
+            write_png(fp, size, size, mode, bands, 1, False, threads)
+        case "npy":
+            write_npy(fp, size, size, mode, bands)
+        case "webp":
+            # WebP and TIFF are encoded by PIL from the whole image
+            image = read_box((0, 0, size, size))
+            image.save(fp, "WEBP", quality=export.webp_quality, lossless=export.webp_quality >= 100, method=4)
+        case "tiff":
+            check_image_format(export)
+            image = read_box((0, 0, size, size))
+            big_tiff = size * size * len(mode) >= 2**31
+            image.save(fp, "TIFF", compression=TIFF_COMPRESSION[export.tiff_compression], strip_size=band_rows * size * len(mode), big_tiff=big_tiff)
+        case _:
+            raise ValueError(f"Unknown export format '{export.format}'")
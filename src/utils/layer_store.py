@@ -0,0 +1,82 @@
+import os
+import uuid
+import numpy as np
+from PIL import Image
+
+# Directory the current process writes its layer files to, set per run
+layers_dir: str|None = None
+
+def init_worker(directory: str|None) -> None:
+    global layers_dir
+    layers_dir = directory
+
+class LayerFile:
+    """A size x size image stored as a memory-mapped .npy file.
+
+    Only the path travels between processes, pixels are read and written in
+    boxes so a layer never has to be resident as a whole.
+    """
+    def __init__(self, path: str, size: int, mode: str):
+        self.path = path
+        self.size = size
+        self.mode = mode
+        self._array = None
+
+    @classmethod
+    def create(cls, size: int, mode: str) -> "LayerFile":
+        if layers_dir is None:
+            raise RuntimeError("No layer directory configured for this process")
+        path = os.path.join(layers_dir, f"{uuid.uuid4().hex}.npy")
+        shape = (size, size) if mode == "L" else (size, size, len(mode))
+        np.lib.format.open_memmap(path, mode="w+", dtype=np.uint8, shape=shape).flush()
+        return cls(path, size, mode)
+
+    @classmethod
+    def from_image(cls, image: Image.Image) -> "LayerFile":
+        layer = cls.create(image.width, image.mode)
+        layer.array[:] = np.asarray(image)
+        layer.flush()
+        return layer
+
+    def to_image(self) -> Image.Image:
+        # Read-only view onto the mapped file, PIL copies it on the first write
+        pixels = np.load(self.path, mmap_mode="r")
+        return Image.frombuffer(self.mode, (self.size, self.size), pixels, "raw", self.mode, 0, 1) # type: ignore
+
+    @property
+    def array(self) -> np.ndarray:
+        if self._array is None:
+            self._array = np.load(self.path, mmap_mode="r+")
+        return self._array
+
+    @property
+    def nbytes(self) -> int:
+        return self.size * self.size * len(self.mode)
+
+    def read(self, box: tuple[int, int, int, int]) -> np.ndarray:
+        left, top, right, bottom = box
+        return np.array(self.array[top:bottom, left:right])
+
+    def read_image(self, box: tuple[int, int, int, int]) -> Image.Image:
+        return Image.fromarray(self.read(box), self.mode)
+
+    def write(self, box: tuple[int, int, int, int], pixels: np.ndarray|Image.Image) -> None:
+        left, top, right, bottom = box
+        self.array[top:bottom, left:right] = np.asarray(pixels)
+
+    def flush(self) -> None:
+        if self._array is not None:
+            self._array.flush()
+
+    def close(self) -> None:
+        # Unmaps the file, the next access maps it again. Windows can't delete mapped files
+        self.flush()
+        self._array = None
+
+    def __getstate__(self):
+        self.flush()
+        return {"path": self.path, "size": self.size, "mode": self.mode}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._array = None
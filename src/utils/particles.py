@@ -0,0 +1,162 @@
+import numpy as np
+from dataclasses import dataclass
+from PIL import Image, ImageDraw
+from src.utils.blur import Blur
+from src.utils.layer_store import LayerFile
+from src.utils.tiles import render_band, render_tiled
+
+SPLAT_BAND_ROWS = 256
+PARTICLE_BACKENDS = ("exact", "splat")
+
+def check_particle_backend(backend: str) -> None:
+    if backend not in PARTICLE_BACKENDS:
+        raise ValueError(f"Unknown particle backend '{backend}'")
+
+@dataclass
+class Particles:
+    x: np.ndarray           # Center x (px)
+    y: np.ndarray           # Center y (px)
+    radius: np.ndarray      # Disc radius (px)
+    color: np.ndarray       # One row per particle, one column per image band
+
+    def __len__(self) -> int:
+        return len(self.x)
+
+    def subset(self, index) -> "Particles":
+        return Particles(self.x[index], self.y[index], self.radius[index], self.color[index])
+
+    @property
+    def reach(self) -> int:
+        # PIL rasterizes discs cut by the edge of a tile differently, up to a
+        # radius into it. Tiles render this much further, so only the part
+        # that gets cropped away differs from a full size render
+        return int(np.ceil(self.radius.max())) + 1 if len(self) else 0
+
+    def in_box(self, box: tuple[int, int, int, int]) -> "Particles":
+        left, top, right, bottom = box
+        return self.subset(
+            (self.x + self.radius >= left) & (self.x - self.radius < right) &
+            (self.y + self.radius >= top) & (self.y - self.radius < bottom)
+        )
+
+def draw_particles(image: Image.Image, particles: Particles, origin: tuple[int, int]=(0, 0)) -> None:
+    draw = ImageDraw.Draw(image)
+    xs = (particles.x - origin[0]).tolist()
+    ys = (particles.y - origin[1]).tolist()
+    single_band = particles.color.shape[1] == 1
+
+    for x, y, rad, color in zip(xs, ys, particles.radius.tolist(), particles.color.tolist()):
+        draw.ellipse([x-rad, y-rad, x+rad, y+rad], fill=color[0] if single_band else tuple(color))
+
+def splat_particles(particles: Particles, box: tuple[int, int, int, int], cell: int=1) -> tuple[np.ndarray, np.ndarray]:
+    # Every pixel gets the mean color of the discs covering it, which is what the
+    # last-writer-wins ImageDraw output converges to for randomly ordered particles.
+    # Discs are accumulated as row spans in a difference buffer on a grid of
+    # cell x cell pixels, so the cost is O(particles * radius / cell + pixels / cell^2)
+    left, top, right, bottom = box
+    width = -(-(right - left) // cell)
+    height = -(-(bottom - top) // cell)
+    bands = particles.color.shape[1]
+
+    values = np.zeros((height, width, bands), dtype=np.uint8)
+    coverage = np.zeros((height, width), dtype=bool)
+    if len(particles) == 0 or width <= 0 or height <= 0:
+        return values, coverage
+
+    # Cell k covers pixels [k*cell, (k+1)*cell), its center sits at k*cell + (cell-1)/2
+    cx = (particles.x - left - (cell - 1) / 2) / cell
+    cy = (particles.y - top - (cell - 1) / 2) / cell
+    reach = np.maximum((particles.radius + 0.5) / cell, 0.5)
+    order = np.argsort(cy, kind="stable")
+    sorted_y = cy[order]
+    max_reach = float(reach.max())
+    weights = np.concatenate([np.ones((len(particles), 1)), particles.color.astype(np.float64)], axis=1)
+
+    for band_top in range(0, height, SPLAT_BAND_ROWS):
+        band_bottom = min(band_top + SPLAT_BAND_ROWS, height)
+        lo = np.searchsorted(sorted_y, band_top - max_reach, "left")
+        hi = np.searchsorted(sorted_y, band_bottom + max_reach, "right")
+        members = order[lo:hi]
+        if len(members) == 0:
+            continue
+
+        first_row = np.maximum(np.ceil(cy[members] - reach[members]), band_top).astype(np.int64)
+        last_row = np.minimum(np.floor(cy[members] + reach[members]), band_bottom - 1).astype(np.int64)
+        counts = np.maximum(last_row - first_row + 1, 0)
+        total = int(counts.sum())
+        if total == 0:
+            continue
+
+        owner = np.repeat(members, counts)
+        rows = np.repeat(first_row, counts) + np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        half = np.sqrt(np.maximum(reach[owner]**2 - (rows - cy[owner])**2, 0))
+        x0 = np.clip(np.ceil(cx[owner] - half), 0, width).astype(np.int64)
+        x1 = np.clip(np.floor(cx[owner] + half) + 1, 0, width).astype(np.int64)
+        valid = x0 < x1
+        owner, rows, x0, x1 = owner[valid], rows[valid], x0[valid], x1[valid]
+
+        band_height = band_bottom - band_top
+        channels = bands + 1
+        starts = ((rows - band_top) * (width + 1) + x0) * channels
+        ends = ((rows - band_top) * (width + 1) + x1) * channels
+        span_weights = weights[owner]
+        index = np.concatenate([(starts[:, None] + np.arange(channels)).ravel(), (ends[:, None] + np.arange(channels)).ravel()])
+        diff = np.bincount(index, np.concatenate([span_weights.ravel(), -span_weights.ravel()]), band_height * (width + 1) * channels)
+        sums = np.cumsum(diff.astype(np.float32).reshape(band_height, width + 1, channels), axis=1)[:, :width]
+
+        count = sums[:, :, :1]
+        covered = count[:, :, 0] > 0.5
+        mean = np.divide(sums[:, :, 1:], count, out=np.zeros((band_height, width, bands), dtype=np.float32), where=count > 0.5)
+        values[band_top:band_bottom] = (mean + 0.5).astype(np.uint8)
+        coverage[band_top:band_bottom] = covered
+
+    return values, coverage
+
+def splat_images(particles: Particles, box: tuple[int, int, int, int], cell: int, mode: str) -> tuple[Image.Image, Image.Image]:
+    values, coverage = splat_particles(particles, box, cell)
+    layer = Image.fromarray(values[:, :, 0] if values.shape[2] == 1 else values, mode)
+    mask = Image.fromarray(coverage.astype(np.uint8) * 255, "L")
+    return layer, mask
+
+def render_particles(image: Image.Image, particles: Particles, backend: str, origin: tuple[int, int]=(0, 0), blur_radius: int=0) -> Image.Image:
+    match backend:
+        case "exact":
+            draw_particles(image, particles, origin)
+        case "splat":
+            # The layer gets blurred by blur_radius afterwards, a much coarser
+            # density grid is indistinguishable once that has happened. Cells are
+            # aligned to the global pixel grid and padded by two cells, so tiles
+            # interpolate exactly like a full size render
+            cell = max(1, blur_radius // 4)
+            left = max(0, (origin[0] // cell - 2) * cell)
+            top = max(0, (origin[1] // cell - 2) * cell)
+            box = (left, top, origin[0] + image.width + 2 * cell, origin[1] + image.height + 2 * cell)
+            layer, mask = splat_images(particles, box, cell, image.mode)
+            if cell > 1:
+                layer = layer.resize((layer.width * cell, layer.height * cell), Image.Resampling.BILINEAR)
+                mask = mask.resize((mask.width * cell, mask.height * cell), Image.Resampling.BILINEAR)
+            image.paste(layer, (left - origin[0], top - origin[1]), mask)
+        case _:
+            raise ValueError(f"Unknown particle backend '{backend}'")
+    return image
+
+def render_particle_layer(size: int, mode: str, particles: Particles, backend: str, blur: Blur, tile_size: int=0, band: tuple[LayerFile, tuple[int, int, int, int]]|None=None) -> Image.Image|LayerFile:
+    def render_tile(box: tuple[int, int, int, int]) -> Image.Image:
+        origin = (box[0], box[1])
+        tile = Image.new(mode, (box[2] - box[0], box[3] - box[1]), 0)
+        if backend == "splat" and blur.factor > 1:
+            # Splatting straight onto the grid of the blur skips the full size layer
+            dx, dy = blur.grid_offset(origin)
+            layer, mask = splat_images(particles.in_box(box), (box[0] + dx, box[1] + dy, box[2], box[3]), blur.factor, mode)
+            reduced = Image.new(mode, layer.size, 0)
+            reduced.paste(layer, (0, 0), mask)
+            return blur.expand(reduced, tile, origin)
+
+        render_particles(tile, particles.in_box(box), backend, origin=origin, blur_radius=blur.radius)
+        return blur.apply(tile, origin)
+
+    if band is not None:
+        return render_band(band, tile_size, blur.halo + particles.reach, render_tile)
+    if tile_size:
+        return render_tiled(size, mode, tile_size, blur.halo + particles.reach, render_tile)
+    return render_tile((0, 0, size, size))
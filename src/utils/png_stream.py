@@ -0,0 +1,100 @@
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Iterable
+import numpy as np
+
+COLOR_TYPES = {"L": 0, "RGB": 2, "RGBA": 6}
+ADLER_BASE = 65521
+
+def _write_chunk(fp: BinaryIO, kind: bytes, data: bytes) -> None:
+    fp.write(struct.pack(">I", len(data)))
+    fp.write(kind)
+    fp.write(data)
+    fp.write(struct.pack(">I", zlib.crc32(data, zlib.crc32(kind))))
+
+def adler32_combine(adler1: int, adler2: int, length2: int) -> int:
+    # Port of zlib's adler32_combine, the checksum of two joined byte strings
+    rem = length2 % ADLER_BASE
+    sum1 = adler1 & 0xffff
+    sum2 = (rem * sum1) % ADLER_BASE
+    sum1 += (adler2 & 0xffff) + ADLER_BASE - 1
+    sum2 += (adler1 >> 16) + (adler2 >> 16) + ADLER_BASE - rem
+    sum1 %= ADLER_BASE
+    sum2 %= ADLER_BASE
+    return sum1 | (sum2 << 16)
+
+def filter_rows(rows: np.ndarray, previous: np.ndarray, channels: int, optimize: bool) -> np.ndarray:
+    # "Sub" on every row, or with optimize the filter that leaves the smallest
+    # residuals per row, like libpng's adaptive filtering
+    left = np.zeros_like(rows)
+    left[:, channels:] = rows[:, :-channels]
+    filtered = np.empty((rows.shape[0], rows.shape[1] + 1), dtype=np.uint8)
+    if not optimize:
+        filtered[:, 0] = 1
+        np.subtract(rows, left, out=filtered[:, 1:])
+        return filtered
+
+    up = np.concatenate([previous[None], rows[:-1]])
+    up_left = np.zeros_like(up)
+    up_left[:, channels:] = up[:, :-channels]
+    a, b, c = left.astype(np.int16), up.astype(np.int16), up_left.astype(np.int16)
+    pa, pb, pc = np.abs(b - c), np.abs(a - c), np.abs(a + b - 2 * c)
+    paeth = np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, up, up_left))
+    candidates = np.stack([rows, rows - left, rows - up, rows - ((a + b) >> 1).astype(np.uint8), rows - paeth])
+    scores = np.abs(candidates.view(np.int8).astype(np.int32)).sum(axis=2)
+    best = scores.argmin(axis=0)
+    filtered[:, 0] = best
+    filtered[:, 1:] = candidates[best, np.arange(rows.shape[0])]
+    return filtered
+
+def encode_band(rows: np.ndarray, previous: np.ndarray, channels: int, compress_level: int, optimize: bool) -> tuple[bytes, int, int]:
+    # Bands are deflated independently and end on a byte boundary, so their
+    # streams can simply be joined like pigz does
+    filtered = filter_rows(rows, previous, channels, optimize).tobytes()
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -15)
+    data = compressor.compress(filtered) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return data, zlib.adler32(filtered), len(filtered)
+
+def write_png(fp: BinaryIO, width: int, height: int, mode: str, bands: Iterable[np.ndarray], compress_level: int=6, optimize: bool=False, threads: int=1) -> None:
+    """Writes a PNG from an iterable of row bands without holding the whole image.
+
+    Bands are filtered and compressed on up to `threads` threads (zlib and
+    NumPy release the GIL) while the next ones are read, and written in order
+    as they finish.
+    """
+    channels = len(mode)
+    fp.write(b"\x89PNG\r\n\x1a\n")
+    _write_chunk(fp, b"IHDR", struct.pack(">IIBBBBB", width, height, 8, COLOR_TYPES[mode], 0, 0, 0))
+
+    checksum = 1
+    def write_band(encoded: tuple[bytes, int, int]) -> None:
+        nonlocal checksum
+        data, adler, length = encoded
+        checksum = adler32_combine(checksum, adler, length)
+        if data:
+            _write_chunk(fp, b"IDAT", data)
+
+    # The zlib header for this level, the raw deflate bands follow it
+    _write_chunk(fp, b"IDAT", zlib.compress(b"", compress_level)[:2])
+    previous = np.zeros(width * channels, dtype=np.uint8)
+    rows_written = 0
+    with ThreadPoolExecutor(max(1, threads)) as executor:
+        pending = deque()
+        for band in bands:
+            rows = band.reshape(band.shape[0], width * channels)
+            pending.append(executor.submit(encode_band, rows, previous, channels, compress_level, optimize))
+            previous = rows[-1].copy()
+            rows_written += rows.shape[0]
+            # A couple of bands in flight per thread keeps them busy without buffering the image
+            while len(pending) > 2 * threads:
+                write_band(pending.popleft().result())
+        while pending:
+            write_band(pending.popleft().result())
+
+    if rows_written != height:
+        raise ValueError(f"Expected {height} rows, got {rows_written}")
+    # An empty final block ends the deflate stream
+    _write_chunk(fp, b"IDAT", zlib.compressobj(compress_level, zlib.DEFLATED, -15).flush() + struct.pack(">I", checksum))
+    _write_chunk(fp, b"IEND", b"")
@@ -1,8 +1,45 @@
 import time
 from PIL import Image
+from src.utils import layer_store
+from src.utils.layer_store import LayerFile
 
 class Result:
-    def __init__(self, ticks: float|None, image: Image.Image, *args):
+    def __init__(self, ticks: float|None, image: Image.Image|LayerFile, *args, particles: int=0):
         self.time = time.time() - ticks if ticks else None
         self.image = image
-        self.data = args
\ No newline at end of file
+        self.data = args
+        self.particles = particles  # Work items of the stage, for throughput numbers
+        self._shared = None
+        self.cached = False
+
+    def __getstate__(self):
+        # Full size images travel between processes as memory-mapped layer
+        # files, so only a path gets pickled and the receiver maps the pixels
+        state = self.__dict__.copy()
+        image = state["image"]
+        if isinstance(image, Image.Image) and image.width == image.height > 1 and layer_store.layers_dir is not None:
+            shared = self._shared
+            if shared is None or not image.readonly or image.size != (shared.size, shared.size):
+                shared = LayerFile.from_image(image)
+            state["image"] = None
+            state["_shared"] = shared
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._shared is not None:
+            self.image = self._shared.to_image()
+
+    def release(self) -> None:
+        # Drops this process' view of the pixels, other stages still get them through the layer file
+        if self._shared is not None:
+            self.image = None # type: ignore
+
+    def close(self) -> None:
+        # Unmaps every layer file behind the result before the run deletes them,
+        # pixels that only lived in those files are gone afterwards
+        if isinstance(self.image, LayerFile):
+            self.image.close()
+        if self._shared is not None:
+            self.release()
+            self._shared.close()
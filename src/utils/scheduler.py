@@ -0,0 +1,145 @@
+import importlib
+from concurrent.futures import Executor, Future, FIRST_COMPLETED, wait
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterable
+from src.utils import layer_store, telemetry
+from src.utils.cache import LayerCache
+from src.utils.result_obj import Result
+
+@dataclass
+class Stage:
+    name: str
+    fn: Callable
+    args: tuple = ()
+    deps: tuple[str, ...] = field(default_factory=tuple)    # Results of these stages get appended to args
+    kwargs: dict[str, Any] = field(default_factory=dict)
+    cache_inputs: tuple|None = None                         # Everything besides deps the output depends on, None never caches
+    parts: tuple["Stage", ...] = field(default_factory=tuple)  # Run in parallel first, their results get appended after the deps
+
+def preload(modules: tuple[str, ...]) -> None:
+    # Worker initializer, the imports are done before the first stage arrives
+    for module in modules:
+        importlib.import_module(module)
+
+def cancel_futures(futures: Iterable[Future]) -> list[Any]:
+    # Drops what hasn't started and waits for the rest, so a failed run
+    # leaves a shared pool idle. Returns what the finished ones produced
+    futures = list(futures)
+    for future in futures:
+        future.cancel()
+    wait(futures)
+    return [future.result() for future in futures if not future.cancelled() and future.exception() is None]
+
+def execute_stage(layers_dir: str|None, telemetry_dirs: tuple[str|None, str|None], name: str, fn: Callable, args: tuple, kwargs: dict[str, Any]) -> Any:
+    # Runs in the worker, layer files and telemetry of this run go to the run's directories
+    layer_store.init_worker(layers_dir)
+    telemetry.configure(*telemetry_dirs)
+    with telemetry.span(name):
+        if telemetry.enabled():
+            telemetry.count("ipc_in_bytes", telemetry.pickled_size((args, kwargs)))
+        result = fn(*args, **kwargs)
+        if telemetry.enabled():
+            # Layers travel as files, only the rest of a Result goes through the pipe
+            telemetry.count("ipc_out_bytes", telemetry.pickled_size(result.data if isinstance(result, Result) else result))
+    return result
+
+def run_stages(executor: Executor, stages: list[Stage], layers_dir: str|None=None, on_result: Callable[[str, Any], None]|None=None, cache: LayerCache|None=None) -> dict[str, Any]:
+    """Runs every stage as soon as all of its dependencies have finished.
+
+    Stages without dependencies are submitted in list order, so slow stages
+    should come first. Cacheable stages are looked up in the cache before
+    they are submitted, their keys include the keys of their dependencies.
+    Parts of a stage only run when the stage itself is no cache hit.
+    """
+    names = [stage.name for stage in stages]
+    for stage in stages:
+        missing = [dep for dep in stage.deps if dep not in names]
+        if missing:
+            raise ValueError(f"Stage '{stage.name}' depends on unknown stages {missing}")
+
+    results = {}
+    keys: dict[str, str|None] = {}
+    pending = list(stages)
+    running: dict[Future, tuple[Stage, int|None]] = {}
+    parts: dict[str, list] = {}
+    parts_left: dict[str, int] = {}
+    hits: list[str] = []
+
+    def submit(stage: Stage, part: int|None=None) -> None:
+        target = stage if part is None else stage.parts[part]
+        args = (*target.args, *(results[dep] for dep in stage.deps))
+        if part is None and stage.parts:
+            args = (*args, *parts.pop(stage.name))
+        # Workers record their telemetry wherever this process does
+        telemetry_dirs = (telemetry.trace_dir, telemetry.profile_dir)
+        running[executor.submit(execute_stage, layers_dir, telemetry_dirs, target.name, target.fn, args, target.kwargs)] = (stage, part)
+
+    def submit_ready() -> None:
+        ready = True
+        while ready:
+            ready = False
+            for stage in list(pending):
+                if not all(dep in results for dep in stage.deps):
+                    continue
+                pending.remove(stage)
+                key = None
+                if cache is not None and stage.cache_inputs is not None and all(keys[dep] for dep in stage.deps):
+                    key = cache.key(stage.name, stage.cache_inputs, tuple(keys[dep] for dep in stage.deps)) # type: ignore
+                keys[stage.name] = key
+
+                hit = cache.load(key) if key else None # type: ignore
+                if hit is not None:
+                    # Cache hits can make more stages ready, so look again
+                    results[stage.name] = hit
+                    hits.append(stage.name)
+                    ready = True
+                    continue
+                if stage.parts:
+                    parts[stage.name] = [None] * len(stage.parts)
+                    parts_left[stage.name] = len(stage.parts)
+                    for part in range(len(stage.parts)):
+                        submit(stage, part)
+                else:
+                    submit(stage)
+
+    def report(names: list[str]) -> None:
+        if on_result:
+            for name in names:
+                on_result(name, results[name])
+
+    try:
+        submit_ready()
+        while running or hits:
+            finished, hits[:] = hits[:], []
+            if running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, part = running.pop(future)
+                    if part is None:
+                        results[stage.name] = future.result()
+                        finished.append(stage.name)
+                        continue
+                    parts[stage.name][part] = future.result()
+                    parts_left[stage.name] -= 1
+                    if not parts_left[stage.name]:
+                        submit(stage)
+
+            # Keep the workers busy before spending time in the callbacks
+            submit_ready()
+            if cache is not None:
+                for name in finished:
+                    if keys[name] and not results[name].cached:
+                        cache.store(keys[name], results[name]) # type: ignore
+            report(finished)
+    except BaseException:
+        # A failed run stops its other stages and keeps no layer files mapped,
+        # the caller deletes them
+        finished = cancel_futures(running)
+        for result in [*results.values(), *(part for stage_parts in parts.values() for part in stage_parts), *finished]:
+            if isinstance(result, Result):
+                result.close()
+        raise
+
+    if pending:
+        raise ValueError(f"Stages {[stage.name for stage in pending]} have circular dependencies")
+    return results
@@ -0,0 +1,16 @@
+import secrets
+import zlib
+import numpy as np
+
+def random_seed() -> int:
+    return secrets.randbits(63)
+
+def stage_seed(seed: int, name: str) -> np.random.SeedSequence:
+    # Streams only depend on the galaxy seed and the stage name, never on
+    # which worker runs the stage or in which order stages are scheduled
+    return np.random.SeedSequence(seed, spawn_key=(zlib.crc32(name.encode()),))
+
+def child_seed(parent: np.random.SeedSequence, index: int) -> np.random.SeedSequence:
+    # Like parent.spawn(), but addressable: child 7 gets the same stream no
+    # matter how many siblings were spawned before it or in which process
+    return np.random.SeedSequence(parent.entropy, spawn_key=(*parent.spawn_key, index))
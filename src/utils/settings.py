@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 @dataclass
 class Parameters:
@@ -6,6 +6,9 @@ class Parameters:
     arms: int
     stars: int
     type: str
+    seed: int|None = None
+    preview: int = 0
+    preview_only: bool = False
 
 @dataclass
 class GalaxyType:
@@ -91,6 +94,33 @@ class Steps:
 class Export:
     png: bool
     zip: bool
+    show: bool = True
+    graph: bool = False
+    graph_json: bool = False
+    star_catalog: str = ""
+    png_compress_level: int = 6
+    png_optimize: bool = False
+    format: str = "png"
+    webp_quality: int = 90
+    tiff_compression: str = "deflate"
+    tiles: str = ""
+    tile_format: str = "png"
+    map_tile_size: int = 256
+
+@dataclass
+class Performance:
+    vectorized_stars: bool = True
+    sprite_stars: bool = True
+    particle_backend: str = "exact"
+    tile_size: int = 0
+    work_dir: str = ""
+    workers: int = 0
+    particle_bands: int = 0
+    blur_engine: str = "exact"
+    cache_dir: str = ""
+    cache_limit_mb: int = 4096
+    telemetry: bool = False
+    profile: bool = False
 
 @dataclass
 class Settings:
@@ -100,6 +130,7 @@ class Settings:
     generation: Generation
     steps: Steps
     export: Export
+    performance: Performance = field(default_factory=dict)  #type: ignore
 
     def __post_init__(self):
         self.parameters = Parameters(**self.parameters) #type: ignore
@@ -109,4 +140,5 @@ class Settings:
             for key, value in self.galaxy_types.items()
         }
         self.steps = Steps(**self.steps) #type: ignore
-        self.export = Export(**self.export) #type: ignore
\ No newline at end of file
+        self.export = Export(**self.export) #type: ignore
+        self.performance = Performance(**self.performance) #type: ignore
@@ -0,0 +1,159 @@
+import math
+import numpy as np
+from src.utils.star_catalog import catalog_positions
+
+# Points per batch of window lookups, bounds the (points x rows) temporaries
+QUERY_BATCH_SIZE = 4096
+# Widest radius any_within reads in one 32-bit word per row: 2r + 1 bits after a shift of up to 7
+WORD_REACH = 12
+# Empty pixels on both sides of every row, so windows never need clipping
+MARGIN = 32
+
+class OccupancyBitmap:
+    """One bit per pixel of a size x size image, about 2 MB at 4000 px.
+
+    Windows are squares around a pixel, like the collision buffers of the
+    stars. Pixels outside the image are never occupied.
+    """
+    def __init__(self, size: int):
+        self.size = size
+        # Three spare bytes, so a word can be read from the last byte of a row
+        self.bits = np.zeros((size, -(-(size + 2 * MARGIN) // 8) + 3), dtype=np.uint8)
+
+    def add(self, xs: np.ndarray, ys: np.ndarray) -> None:
+        xs, ys = np.asarray(xs, dtype=np.int64) + MARGIN, np.asarray(ys, dtype=np.int64)
+        # Several pixels can share a byte, so the bits are or-ed in unbuffered
+        np.bitwise_or.at(self.bits, (ys, xs >> 3), np.left_shift(1, xs & 7).astype(np.uint8))
+
+    def contains(self, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        xs, ys = np.asarray(xs, dtype=np.int64), np.asarray(ys, dtype=np.int64)
+        inside = (0 <= xs) & (xs < self.size) & (0 <= ys) & (ys < self.size)
+        xs, ys = np.clip(xs, 0, self.size - 1) + MARGIN, np.clip(ys, 0, self.size - 1)
+        return inside & ((self.bits[ys, xs >> 3] >> (xs & 7)) & 1).astype(bool)
+
+    def any_near(self, x: int, y: int, radius: int) -> bool:
+        # Single lookup for scalar loops: unpacks only the bytes under the window
+        left, top = max(0, x - radius) + MARGIN, max(0, y - radius)
+        right, bottom = min(self.size - 1, x + radius) + MARGIN, min(self.size - 1, y + radius)
+        if left > right or top > bottom:
+            return False
+        rows = self.bits[top:bottom + 1, left >> 3:(right >> 3) + 1]
+        if not rows.any():
+            return False
+        start = left & 7
+        return bool(np.unpackbits(rows, axis=1, bitorder="little")[:, start:start + right - left + 1].any())
+
+    def any_within(self, xs: np.ndarray, ys: np.ndarray, radii: np.ndarray) -> np.ndarray:
+        # Batched any_near, every point with its own radius of up to WORD_REACH
+        xs, ys, radii = np.asarray(xs, dtype=np.int64), np.asarray(ys, dtype=np.int64), np.asarray(radii, dtype=np.int64)
+        hits = np.zeros(len(xs), dtype=bool)
+        if len(xs) == 0:
+            return hits
+        reach = int(radii.max())
+        if reach > WORD_REACH:
+            raise ValueError(f"Windows reach at most {WORD_REACH} pixels, got {reach}")
+
+        rows = np.arange(-reach, reach + 1)
+        # Windows entirely left or right of the image stay entirely in the margin
+        xs = np.clip(xs, -reach - 1, self.size + reach)
+        for start in range(0, len(xs), QUERY_BATCH_SIZE):
+            end = start + QUERY_BATCH_SIZE
+            r = radii[start:end, None]
+            first = xs[start:end, None] - r + MARGIN
+            column, shift = first >> 3, (first & 7).astype(np.uint32)
+            y = ys[start:end, None] + rows
+            valid = (0 <= y) & (y < self.size) & (np.abs(rows) <= r)
+            y = np.clip(y, 0, self.size - 1)
+            word = np.zeros(y.shape, dtype=np.uint32)
+            for byte in range(4):
+                word |= self.bits[y, column + byte].astype(np.uint32) << np.uint32(8 * byte)
+            mask = ((1 << (2 * r + 1)) - 1).astype(np.uint32)
+            hits[start:end] = (((word >> shift) & mask).astype(bool) & valid).any(axis=1)
+        return hits
+
+class StarIndex:
+    """The star catalog and the lookups later stages run on it.
+
+    Positions are distinct, the collision check sees to that, and sorted by
+    x, then y, so star ids are the same in every process. The occupancy
+    bitmap and the grid buckets are derived from the positions when first
+    used, only the catalog gets pickled.
+    """
+    def __init__(self, catalog: np.ndarray, size: int):
+        self.catalog = catalog[np.lexsort((catalog["y"], catalog["x"]))]
+        self.size = size
+        self._bitmap = None
+        self._grids = {}
+
+    def __len__(self) -> int:
+        return len(self.catalog)
+
+    def __getstate__(self):
+        return {"catalog": self.catalog, "size": self.size}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._bitmap = None
+        self._grids = {}
+
+    @property
+    def coords(self) -> np.ndarray:
+        return catalog_positions(self.catalog)
+
+    @property
+    def bitmap(self) -> OccupancyBitmap:
+        if self._bitmap is None:
+            self._bitmap = OccupancyBitmap(self.size)
+            self._bitmap.add(self.coords[:, 0], self.coords[:, 1])
+        return self._bitmap
+
+    def any_within(self, xs: np.ndarray, ys: np.ndarray, radii: np.ndarray) -> np.ndarray:
+        return self.bitmap.any_within(xs, ys, radii)
+
+    def grid(self, cell: int) -> tuple[int, np.ndarray, np.ndarray]:
+        # Uniform grid of cell x cell buckets: star ids sorted by bucket, and
+        # where every bucket starts in them
+        if cell not in self._grids:
+            columns = self.size // cell + 1
+            coords = self.coords.astype(np.int64)
+            keys = (coords[:, 1] // cell) * columns + coords[:, 0] // cell
+            ids = np.argsort(keys, kind="stable")
+            starts = np.searchsorted(keys[ids], np.arange(columns * columns + 1))
+            self._grids[cell] = (columns, ids, starts)
+        return self._grids[cell]
+
+    def within(self, points: np.ndarray, radius: float) -> list[np.ndarray]:
+        """Ids of the stars at most radius away from each point, in ascending order."""
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        if len(points) == 0 or len(self.coords) == 0:
+            return [np.zeros(0, dtype=np.int64) for _ in range(len(points))]
+
+        # Buckets as wide as the radius, so the 3 x 3 around a point cover it
+        cell = max(1, math.ceil(radius))
+        columns, ids, starts = self.grid(cell)
+        cell_x = np.floor(points[:, 0] / cell).astype(np.int64)
+        cell_y = np.floor(points[:, 1] / cell).astype(np.int64)
+        owners, found = [], []
+        for dy in (-1, 0, 1):
+            for dx in (-1, 0, 1):
+                x, y = cell_x + dx, cell_y + dy
+                valid = (0 <= x) & (x < columns) & (0 <= y) & (y < columns)
+                keys = np.where(valid, y * columns + x, 0)
+                lo = np.where(valid, starts[keys], 0)
+                counts = np.where(valid, starts[keys + 1], 0) - lo
+                total = int(counts.sum())
+                if total == 0:
+                    continue
+                offsets = np.repeat(lo - (np.cumsum(counts) - counts), counts)
+                owners.append(np.repeat(np.arange(len(points)), counts))
+                found.append(ids[offsets + np.arange(total)])
+
+        if not owners:
+            return [np.zeros(0, dtype=np.int64) for _ in range(len(points))]
+        owner, star = np.concatenate(owners), np.concatenate(found)
+        delta = self.coords[star] - points[owner]
+        near = (delta ** 2).sum(axis=1) <= radius * radius
+        owner, star = owner[near], star[near]
+        order = np.lexsort((star, owner))
+        owner, star = owner[order], star[order]
+        return np.split(star, np.searchsorted(owner, np.arange(1, len(points))))
@@ -0,0 +1,23 @@
+import numpy as np
+from numpy.lib.recfunctions import structured_to_unstructured
+
+# One packed record per placed star, 15 bytes. Spectral class and shape
+# index the tables of generate_stars, arm is -1 for core stars
+STAR_DTYPE = np.dtype([
+    ("x", np.int32),
+    ("y", np.int32),
+    ("spectral", np.uint8),
+    ("shape", np.uint8),
+    ("brightness", np.float32),
+    ("arm", np.int8),
+])
+
+def star_catalog(x: np.ndarray, y: np.ndarray, spectral: np.ndarray, shape: np.ndarray, brightness: np.ndarray, arm: np.ndarray) -> np.ndarray:
+    catalog = np.empty(len(x), dtype=STAR_DTYPE)
+    for name, column in zip(STAR_DTYPE.names, (x, y, spectral, shape, brightness, arm)): # type: ignore
+        catalog[name] = column
+    return catalog
+
+def catalog_positions(catalog: np.ndarray) -> np.ndarray:
+    # (n, 2) view onto the x and y columns, nothing gets copied
+    return structured_to_unstructured(catalog[["x", "y"]], copy=False)
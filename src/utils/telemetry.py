@@ -0,0 +1,99 @@
+import cProfile
+import json
+import os
+import pickle
+import sys
+import time
+from contextlib import contextmanager
+from typing import Any, Iterator
+
+try:
+    import resource
+except ImportError:  # Windows has no getrusage
+    resource = None
+
+# Directories the current process records to, set per run like the layer directory
+trace_dir: str|None = None
+profile_dir: str|None = None
+_counters: list[dict[str, int]] = []
+
+def configure(traces: str|None, profiles: str|None=None) -> None:
+    global trace_dir, profile_dir
+    trace_dir, profile_dir = traces, profiles
+
+def enabled() -> bool:
+    return trace_dir is not None
+
+def count(name: str, value: int=1) -> None:
+    # Adds to the innermost open span, does nothing while nothing is recorded
+    if _counters:
+        _counters[-1][name] = _counters[-1].get(name, 0) + int(value)
+
+def pickled_size(value: Any) -> int:
+    # Stands in for the bytes a value costs to send between processes
+    return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+def peak_rss_mb() -> float|None:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+@contextmanager
+def span(name: str) -> Iterator[dict[str, int]|None]:
+    """Records wall and CPU time, peak RSS and the counters of a block of work.
+
+    Every process appends its records to its own file in trace_dir, so workers
+    never share a file. With profile_dir set the outermost span also dumps a
+    cProfile of itself there.
+    """
+    if trace_dir is None:
+        yield None
+        return
+
+    counters: dict[str, int] = {}
+    # Only one profiler can be active at a time, nested spans are part of the outer one
+    profiler = cProfile.Profile() if profile_dir is not None and not _counters else None
+    _counters.append(counters)
+    start_time, start_cpu = time.time(), time.process_time()
+    if profiler:
+        profiler.enable()
+    try:
+        yield counters
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(profile_dir, f"{name}.prof")) # type: ignore
+        _counters.pop()
+        record = {
+            "name": name, "pid": os.getpid(), "start": start_time,
+            "wall_s": round(time.time() - start_time, 6), "cpu_s": round(time.process_time() - start_cpu, 6),
+            "peak_rss_mb": peak_rss_mb(), "counters": counters,
+        }
+        with open(os.path.join(trace_dir, f"{os.getpid()}.jsonl"), "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+def read_records(directory: str) -> list[dict[str, Any]]:
+    records = []
+    for file in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, file), "r") as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return sorted(records, key=lambda record: record["start"])
+
+def write_chrome_trace(records: list[dict[str, Any]], path: str) -> None:
+    # Complete events per span and one track per process, opens in chrome://tracing and Perfetto
+    origin = min((record["start"] for record in records), default=0)
+    main_pid = os.getpid()
+    events: list[dict[str, Any]] = [
+        {"name": "process_name", "ph": "M", "pid": pid, "args": {"name": "main" if pid == main_pid else f"worker {pid}"}}
+        for pid in sorted({record["pid"] for record in records})
+    ]
+    for record in records:
+        events.append({
+            "name": record["name"], "ph": "X", "pid": record["pid"], "tid": 0,
+            "ts": round((record["start"] - origin) * 1e6), "dur": round(record["wall_s"] * 1e6),
+            "args": {"cpu_s": record["cpu_s"], "peak_rss_mb": record["peak_rss_mb"], **record["counters"]},
+        })
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
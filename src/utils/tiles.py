@@ -0,0 +1,201 @@
+from typing import Callable, Iterable, Iterator
+import numpy as np
+from PIL import Image
+from src.utils.layer_store import LayerFile
+from src.utils.result_obj import Result
+
+# Shape rows a DrawRecorder rasterizes at once while replaying, bounds the temporaries
+REPLAY_BATCH_ROWS = 1 << 16
+
+def tile_boxes(size: int, tile_size: int) -> Iterator[tuple[int, int, int, int]]:
+    for top in range(0, size, tile_size):
+        for left in range(0, size, tile_size):
+            yield left, top, min(left + tile_size, size), min(top + tile_size, size)
+
+def band_boxes(size: int, rows: int) -> Iterator[tuple[int, int, int, int]]:
+    for top in range(0, size, rows):
+        yield 0, top, size, min(top + rows, size)
+
+def gaussian_halo(radius: float) -> int:
+    # PIL approximates the gaussian with three box passes of roughly the same radius
+    return int(3 * radius) + 3
+
+def box_halo(radius: float) -> int:
+    return int(radius) + 2
+
+def render_into(layer: LayerFile, boxes: Iterable[tuple[int, int, int, int]], halo: int, render_tile: Callable[[tuple[int, int, int, int]], Image.Image]) -> LayerFile:
+    # Each tile is rendered with a halo wide enough for the blur and cropped
+    # afterwards. The halo stops at the image border so edge pixels see the
+    # same clamping as in a full size render
+    size = layer.size
+    for left, top, right, bottom in boxes:
+        padded = (max(0, left - halo), max(0, top - halo), min(size, right + halo), min(size, bottom + halo))
+        tile = render_tile(padded)
+        tile = tile.crop((left - padded[0], top - padded[1], right - padded[0], bottom - padded[1]))
+        layer.write((left, top, right, bottom), tile)
+    layer.flush()
+    return layer
+
+def render_tiled(size: int, mode: str, tile_size: int, halo: int, render_tile: Callable[[tuple[int, int, int, int]], Image.Image]) -> LayerFile:
+    return render_into(LayerFile.create(size, mode), tile_boxes(size, tile_size), halo, render_tile)
+
+def render_band(band: tuple[LayerFile, tuple[int, int, int, int]], tile_size: int, halo: int, render_tile: Callable[[tuple[int, int, int, int]], Image.Image]) -> LayerFile:
+    # Renders one band of a layer that is shared with the other band processes
+    layer, (left, top, right, bottom) = band
+    boxes = [(left, top, right, bottom)]
+    if tile_size:
+        boxes = [(x, y, min(x + tile_size, right), min(y + tile_size, bottom)) for y in range(top, bottom, tile_size) for x in range(left, right, tile_size)]
+    return render_into(layer, boxes, halo, render_tile)
+
+def join_bands(tiled: bool, *bands: Result) -> Result:
+    # Every band wrote into the same layer file, skipped stages return a placeholder instead
+    first = bands[0]
+    if not isinstance(first.image, LayerFile):
+        return first
+    layer = first.image
+    result = Result(None, layer if tiled else layer.to_image(), particles=first.particles)
+    if not tiled:
+        result._shared = layer
+    result.time = sum(band.time or 0 for band in bands)
+    return result
+
+class DrawRecorder:
+    """Records ImageDraw calls so they can be replayed into each tile.
+
+    PIL rasterizes wide lines differently depending on where they get
+    clipped, so the shapes are rasterized here instead, with integer math on
+    the pixel positions in the full image. Any tile, and the full image
+    itself, gets exactly the pixels of the full size render. Circles keep
+    the shape of PIL's, lines the width and the square ends.
+    """
+    def __init__(self, size: int, cell: int = 0):
+        self.size = size
+        # Shapes are bucketed by the cell x cell squares they touch, tiles of
+        # the same size only look at the shapes in their own bucket
+        self.cell = cell or size
+        # (bounds, circle, (x0, y0, x1, y1, radius or width), fill), bounds inclusive
+        self.shapes = []
+        self._arrays = None
+        self._grid = None
+
+    def circle(self, xy, radius, fill=None) -> None:
+        x, y = xy
+        self.shapes.append(((x - radius, y - radius, x + radius, y + radius), True, (x, y, x, y, radius), fill))
+        self._arrays = self._grid = None
+
+    def line(self, xy, fill=None, width=0) -> None:
+        # Polylines are split into segments, every one ordered the same way
+        # whichever way it was drawn, so the rounding doesn't depend on it
+        width = max(1, width)
+        for a, b in zip(xy[:-1], xy[1:]):
+            (x0, y0), (x1, y1) = sorted((tuple(a), tuple(b)))
+            bounds = (min(x0, x1) - width, min(y0, y1) - width, max(x0, x1) + width, max(y0, y1) + width)
+            self.shapes.append((bounds, False, (x0, y0, x1, y1, width), fill))
+        self._arrays = self._grid = None
+
+    def arrays(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        if self._arrays is None:
+            bounds = np.array([shape[0] for shape in self.shapes], dtype=np.int64).reshape(-1, 4)
+            circles = np.array([shape[1] for shape in self.shapes], dtype=bool)
+            params = np.array([shape[2] for shape in self.shapes], dtype=np.int64).reshape(-1, 5)
+            self._arrays = (bounds, circles, params)
+        return self._arrays
+
+    def grid(self) -> tuple[int, np.ndarray, np.ndarray]:
+        # Shape ids sorted by bucket, in drawing order within each, and where
+        # every bucket starts in them
+        if self._grid is None:
+            bounds = self.arrays()[0]
+            columns = -(-self.size // self.cell)
+            first = np.clip(bounds[:, :2] // self.cell, 0, columns - 1)
+            last = np.clip(bounds[:, 2:] // self.cell, 0, columns - 1)
+            spans = last - first + 1
+            counts = spans[:, 0] * spans[:, 1]
+            owner = np.repeat(np.arange(len(bounds)), counts)
+            offset = np.arange(int(counts.sum())) - np.repeat(np.cumsum(counts) - counts, counts)
+            x = first[owner, 0] + offset % spans[owner, 0]
+            y = first[owner, 1] + offset // spans[owner, 0]
+            keys = y * columns + x
+            ids = owner[np.argsort(keys, kind="stable")]
+            starts = np.searchsorted(np.sort(keys), np.arange(columns * columns + 1))
+            self._grid = (columns, ids, starts)
+        return self._grid
+
+    def candidates(self, box: tuple[int, int, int, int]) -> np.ndarray:
+        # Ids of the shapes in the buckets under the box, in drawing order
+        columns, ids, starts = self.grid()
+        left, top, right, bottom = box
+        found = [ids[starts[y * columns + x]:starts[y * columns + x + 1]]
+                 for y in range(max(0, top // self.cell), min(columns, -(-bottom // self.cell)))
+                 for x in range(max(0, left // self.cell), min(columns, -(-right // self.cell)))]
+        return np.unique(np.concatenate([np.zeros(0, dtype=np.int64), *found]))
+
+    @staticmethod
+    def _covers(circles: np.ndarray, params: np.ndarray, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+        x0, y0, x1, y1, extent = params.T
+        dx, dy = x1 - x0, y1 - y0
+        length2 = dx * dx + dy * dy
+        along = (xs - x0) * dx + (ys - y0) * dy
+        # Twice the signed distance from the line, times its length; width
+        # pixels across, from -width / 2 up to but not including width / 2
+        across = 2 * ((ys - y0) * dx - (xs - x0) * dy)
+        limit = extent * extent * length2
+        line = (0 <= along) & (along <= length2) & np.where(across < 0, across * across <= limit, across * across < limit)
+        circle = (xs - x0) ** 2 + (ys - y0) ** 2 <= extent * (extent + 1)
+        return np.where(circles, circle, line)
+
+    @staticmethod
+    def _row_span(circles: np.ndarray, params: np.ndarray, ys: np.ndarray, lo: np.ndarray, hi: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        # Narrows the columns a line can cover in each row, a pixel wider on
+        # both sides than the float math says, the exact test has the last word
+        x0, y0, x1, y1, width = params.T
+        dx, dy, rows = x1 - x0, y1 - y0, ys - y0
+        half = width * np.sqrt(dx * dx + dy * dy) / 2
+        bounds = (
+            (dy, rows * dx - half, rows * dx + half),
+            (dx, -rows * dy, dx * dx + dy * dy - rows * dy),
+        )
+        for divisor, first, last in bounds:
+            use = ~circles & (divisor != 0)
+            divisor = np.where(use, divisor, 1)
+            first, last = x0 + first / divisor, x0 + last / divisor
+            lo = np.where(use, np.maximum(lo, np.floor(np.minimum(first, last)).astype(np.int64) - 1), lo)
+            hi = np.where(use, np.minimum(hi, np.ceil(np.maximum(first, last)).astype(np.int64) + 2), hi)
+        return lo, hi
+
+    def replay(self, image: Image.Image, origin: tuple[int, int]) -> None:
+        left, top = origin
+        right, bottom = left + image.width, top + image.height
+        bounds, circles, params = self.arrays()
+        ids = self.candidates((left, top, right, bottom))
+        x0, y0 = np.maximum(bounds[ids, 0], left), np.maximum(bounds[ids, 1], top)
+        x1, y1 = np.minimum(bounds[ids, 2] + 1, right), np.minimum(bounds[ids, 3] + 1, bottom)
+        visible = (x0 < x1) & (y0 < y1)
+        ids, x0, y0, x1, y1 = ids[visible], x0[visible], y0[visible], x1[visible], y1[visible]
+        if len(ids) == 0:
+            return
+
+        # The pixels under the visible shapes are tested in batches, in runs of
+        # one fill color so later shapes still paint over earlier ones
+        pixels = np.array(image)
+        heights = y1 - y0
+        fills = [self.shapes[i][3] for i in ids.tolist()]
+        start = 0
+        while start < len(ids):
+            end, total = start + 1, int(heights[start])
+            while end < len(ids) and fills[end] == fills[start] and total + heights[end] <= REPLAY_BATCH_ROWS:
+                total += int(heights[end])
+                end += 1
+            counts = heights[start:end]
+            owner = np.repeat(np.arange(start, end), counts)
+            ys = y0[owner] + np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+            shape_circles, shape_params = circles[ids[owner]], params[ids[owner]]
+            lo, hi = self._row_span(shape_circles, shape_params, ys, x0[owner], x1[owner])
+            counts = np.maximum(hi - lo, 0)
+            row = np.repeat(np.arange(total), counts)
+            xs = lo[row] + np.arange(int(counts.sum())) - np.repeat(np.cumsum(counts) - counts, counts)
+            ys = ys[row]
+            covered = self._covers(shape_circles[row], shape_params[row], xs, ys)
+            pixels[ys[covered] - top, xs[covered] - left] = fills[start]
+            start = end
+        image.paste(Image.fromarray(pixels, image.mode))
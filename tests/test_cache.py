@@ -0,0 +1,23 @@
+import copy
+import os
+from dataclasses import replace
+import main
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def render_settings(**performance) -> main.Settings:
+    settings = copy.copy(main.load_settings(os.path.join(ROOT, "settings.hjson")))
+    settings.export = replace(settings.export, png=False, zip=False, show=False, graph=False, star_catalog="", tiles="")
+    settings.performance = replace(settings.performance, workers=1, **performance)
+    return settings
+
+def test_tiled_stars_are_not_reused_by_legacy_render(tmp_path):
+    # Tiled renders always place stars in batches, even with vectorized_stars off
+    cache_dir = str(tmp_path / "cache")
+    main.generate_galaxy(render_settings(tile_size=128, vectorized_stars=False, cache_dir=cache_dir), 400, "Sb", 4, 4000, 7, output_dir=str(tmp_path / "tiled"))
+    cached = main.generate_galaxy(render_settings(vectorized_stars=False, cache_dir=cache_dir), 400, "Sb", 4, 4000, 7, output_dir=str(tmp_path / "legacy"))
+    fresh = main.generate_galaxy(render_settings(vectorized_stars=False, cache_dir=""), 400, "Sb", 4, 4000, 7, output_dir=str(tmp_path / "fresh"))
+
+    assert not cached["stars"].cached
+    assert len(cached["stars"].data[0]) == len(fresh["stars"].data[0])
+    assert (cached["stars"].data[0].catalog == fresh["stars"].data[0].catalog).all()
@@ -0,0 +1,50 @@
+import io
+import struct
+import zlib
+import numpy as np
+import pytest
+from PIL import Image
+from src.utils.png_stream import write_png
+
+def read_chunks(data: bytes) -> list[tuple[bytes, bytes]]:
+    assert data[:8] == b"\x89PNG\r\n\x1a\n"
+    chunks, offset = [], 8
+    while offset < len(data):
+        length, kind = struct.unpack(">I4s", data[offset:offset + 8])
+        body = data[offset + 8:offset + 8 + length]
+        crc, = struct.unpack(">I", data[offset + 8 + length:offset + 12 + length])
+        assert crc == zlib.crc32(body, zlib.crc32(kind))
+        chunks.append((kind, body))
+        offset += 12 + length
+    return chunks
+
+@pytest.mark.parametrize("mode", ["L", "RGB", "RGBA"])
+@pytest.mark.parametrize("width, height, band_rows", [(1, 1, 1), (37, 53, 8), (101, 64, 17), (64, 30, 64)])
+@pytest.mark.parametrize("optimize", [False, True])
+@pytest.mark.parametrize("threads", [1, 3])
+def test_streamed_png_round_trips(mode, width, height, band_rows, optimize, threads):
+    rng = np.random.default_rng(width * height)
+    shape = (height, width) if mode == "L" else (height, width, len(mode))
+    # Noise next to smooth gradients, so every filter gets picked somewhere
+    pixels = rng.integers(0, 256, shape, dtype=np.uint8)
+    gradient = (np.arange(width) * 3 % 256).astype(np.uint8)
+    pixels[:height // 2] = gradient.reshape((1, width) + (1,) * (len(shape) - 2))
+
+    fp = io.BytesIO()
+    write_png(fp, width, height, mode, (pixels[top:top + band_rows] for top in range(0, height, band_rows)), 6, optimize, threads)
+    data = fp.getvalue()
+
+    chunks = read_chunks(data)
+    assert chunks[0][0] == b"IHDR" and chunks[-1] == (b"IEND", b"")
+    # zlib.decompress checks the combined adler32 at the end of the stream
+    raw = zlib.decompress(b"".join(body for kind, body in chunks if kind == b"IDAT"))
+    rows = np.frombuffer(raw, dtype=np.uint8).reshape(height, 1 + width * len(mode))
+    assert set(rows[:, 0].tolist()) <= ({1} if not optimize else {0, 1, 2, 3, 4})
+
+    decoded = Image.open(io.BytesIO(data))
+    assert decoded.mode == mode and decoded.size == (width, height)
+    assert np.array_equal(np.asarray(decoded), pixels)
+
+def test_missing_rows_are_an_error():
+    with pytest.raises(ValueError):
+        write_png(io.BytesIO(), 4, 4, "L", [np.zeros((3, 4), dtype=np.uint8)])
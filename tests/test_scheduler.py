@@ -0,0 +1,41 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import main
+from src.utils.scheduler import Stage, run_stages
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_failed_run_leaves_the_pool_idle():
+    # One worker: "slow" starts once "broken" failed, "queued" must never start
+    started, finished = [], []
+    lock = threading.Lock()
+    def broken():
+        raise RuntimeError("broken stage")
+    def work(name):
+        with lock:
+            started.append(name)
+        time.sleep(0.2)
+        finished.append(name)
+
+    stages = [Stage("broken", broken), Stage("slow", work, ("slow",)), Stage("queued", work, ("queued",))]
+    with ThreadPoolExecutor(1) as executor:
+        with pytest.raises(RuntimeError):
+            run_stages(executor, stages)
+        assert finished == started
+    # Leaving the pool ran whatever was still queued
+    assert "queued" not in started
+
+def test_batch_reports_unexpected_errors(tmp_path, monkeypatch):
+    def generate_galaxy(settings, size, *args, **kwargs):
+        if size == 1:
+            raise RuntimeError("worker crashed")
+        return {}
+    monkeypatch.setattr(main, "generate_galaxy", generate_galaxy)
+    settings = main.load_settings(os.path.join(ROOT, "settings.hjson"))
+
+    report = main.run_batch(settings, [(1, 1, "Sb", 4, 10), (2, 2, "Sb", 4, 10)], str(tmp_path))
+    assert report[0]["error"] == "RuntimeError: worker crashed"
+    assert "error" not in report[1]
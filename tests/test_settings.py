@@ -0,0 +1,22 @@
+import copy
+import os
+from dataclasses import replace
+import pytest
+import main
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.mark.parametrize("section, field, value", [
+    ("export", "format", "bmp"),
+    ("export", "tiff_compression", "zstd"),
+    ("performance", "particle_backend", "fast"),
+    ("performance", "blur_engine", "fft"),
+])
+def test_unknown_options_fail_before_rendering(tmp_path, section, field, value):
+    settings = copy.copy(main.load_settings(os.path.join(ROOT, "settings.hjson")))
+    settings.export = replace(settings.export, format="tiff")
+    setattr(settings, section, replace(getattr(settings, section), **{field: value}))
+    output_dir = tmp_path / "out"
+    with pytest.raises(ValueError, match=value):
+        main.generate_galaxy(settings, 400, "Sb", 4, 1000, 7, output_dir=str(output_dir))
+    assert not output_dir.exists()
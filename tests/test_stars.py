@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+from src import generate_stars
+from src.generate_stars import STAR_SHAPES, resolve_batch_collisions, resolve_collisions
+
+def place_one_by_one(xs: np.ndarray, ys: np.ndarray, radii: np.ndarray) -> np.ndarray:
+    # The rule of the scalar loop: a star is rejected when an accepted one lies
+    # inside the square of its own radius
+    accepted = np.zeros(len(xs), dtype=bool)
+    for i in range(len(xs)):
+        near = (np.abs(xs[:i] - xs[i]) <= radii[i]) & (np.abs(ys[:i] - ys[i]) <= radii[i])
+        accepted[i] = not (near & accepted[:i]).any()
+    return accepted
+
+def crowded_candidates(seed: int, count: int, size: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Dense enough that most candidates collide, duplicates and image edges included
+    rng = np.random.default_rng(seed)
+    xs = rng.integers(0, size, count)
+    ys = rng.integers(0, size, count)
+    radii = np.array([reach for _, reach in STAR_SHAPES])[rng.integers(0, len(STAR_SHAPES), count)]
+    return xs, ys, radii
+
+@pytest.mark.parametrize("batch_size", [1, 7, 64, 4096])
+@pytest.mark.parametrize("seed", range(4))
+def test_batched_placement_matches_scalar_loop(monkeypatch, batch_size, seed):
+    monkeypatch.setattr(generate_stars, "STAR_BATCH_SIZE", batch_size)
+    xs, ys, radii = crowded_candidates(seed, 800, 60)
+    accepted = resolve_collisions(xs, ys, radii, 60)
+    assert 0 < accepted.sum() < len(xs)
+    assert np.array_equal(accepted, place_one_by_one(xs, ys, radii))
+
+def test_collisions_within_one_batch():
+    xs, ys, radii = crowded_candidates(9, 500, 40)
+    assert np.array_equal(resolve_batch_collisions(xs, ys, radii, int(radii.max())), place_one_by_one(xs, ys, radii))
@@ -0,0 +1,61 @@
+import copy
+import io
+import os
+import zipfile
+from dataclasses import replace
+import numpy as np
+import pytest
+from PIL import Image
+import main
+from src.export_tiles import check_tiles
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def render_layer(tmp_path, layer: str, size: int, num_stars: int, tile_size: int, **performance) -> np.ndarray:
+    settings = copy.copy(main.load_settings(os.path.join(ROOT, "settings.hjson")))
+    settings.steps = replace(settings.steps, spirals=False, dust=False, nebula=layer == "02_h2_nebula.png")
+    settings.export = replace(settings.export, png=False, zip=True, show=False, graph=False, star_catalog="", tiles="", format="png")
+    settings.performance = replace(settings.performance, workers=1, tile_size=tile_size, cache_dir="", **performance)
+    output_dir = str(tmp_path / f"tiles_{size}_{tile_size}")
+    main.generate_galaxy(settings, size, "Sb", 4, num_stars, 7, output_dir=output_dir)
+    with zipfile.ZipFile(os.path.join(output_dir, "galaxy_layers.zip")) as archive:
+        return np.asarray(Image.open(io.BytesIO(archive.read(layer))))
+
+@pytest.mark.parametrize("size, num_stars, tile_size", [(800, 20000, 64), (800, 20000, 128), (800, 20000, 256), (1600, 4000, 96), (1600, 4000, 256)])
+def test_tiled_hyperlanes_match_full_render(tmp_path, size, num_stars, tile_size):
+    # Lanes crossing a tile edge used to rasterize differently where they got clipped
+    full = render_layer(tmp_path, "03_hyperlanes.png", size, num_stars, 0)
+    tiled = render_layer(tmp_path, "03_hyperlanes.png", size, num_stars, tile_size)
+    assert np.array_equal(full, tiled)
+
+@pytest.mark.parametrize("blur_engine", ["exact", "downsample"])
+def test_tiled_nebula_matches_full_render(tmp_path, blur_engine):
+    # Discs cut by the edge of a tile used to reach into it through the blur
+    full = render_layer(tmp_path, "02_h2_nebula.png", 800, 3000, 0, blur_engine=blur_engine)
+    tiled = render_layer(tmp_path, "02_h2_nebula.png", 800, 3000, 128, blur_engine=blur_engine)
+    assert np.array_equal(full, tiled)
+
+def test_tiles_need_the_composited_image():
+    settings = copy.copy(main.load_settings(os.path.join(ROOT, "settings.hjson")))
+    settings.export = replace(settings.export, png=False, tiles="xyz")
+    with pytest.raises(ValueError):
+        check_tiles(settings, 1024)
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/maps"), reason="needs /proc/self/maps")
+def test_layer_files_are_unmapped_before_deleting(tmp_path, monkeypatch):
+    # Windows refuses to delete mapped files, so nothing may still map them
+    def mapped_layers() -> list[str]:
+        with open("/proc/self/maps") as maps:
+            return [line for line in maps if "galaxy_layers_" in line]
+    rmtree, mapped = main.shutil.rmtree, []
+    def checked_rmtree(path, *args, **kwargs):
+        mapped.extend(mapped_layers())
+        return rmtree(path, *args, **kwargs)
+    monkeypatch.setattr(main.shutil, "rmtree", checked_rmtree)
+
+    settings = copy.copy(main.load_settings(os.path.join(ROOT, "settings.hjson")))
+    settings.export = replace(settings.export, png=True, zip=True, show=False, graph=False, star_catalog="", tiles="xyz", format="png")
+    settings.performance = replace(settings.performance, workers=2, tile_size=128, cache_dir="")
+    results = main.generate_galaxy(settings, 400, "Sb", 4, 2000, 7, output_dir=str(tmp_path))
+    assert results["tiles"].data[0] > 0
+    assert mapped == []